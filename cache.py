@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# folder of the cache and its maximum size in bytes (0 disables the cache), set by configure()
+folder = None
+max_size = 0
+
+
+def configure(settings, default_folder: str):
+    """
+    Set the folder and the size of the cache shared by all the sources (see config_example.yaml)
+
+    Args:
+        settings: the cache section of the config, may be None
+        default_folder: folder used if the config does not give one
+    """
+    global folder, max_size
+    settings = settings or {}
+    folder = settings.get("folder") or default_folder
+    max_size = int(settings.get("max_size", 20 << 30))
+
+
+def file_digest(input_file: str, block_size=1 << 20):
+    """
+    Args:
+        input_file: name and path of the file
+    Returns:
+        The sha256 of the content of the file
+    """
+    digest = hashlib.sha256()
+    with open(input_file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def entry_key(version: str, inputs: list):
+    """
+    Key of the parsed data of some inputs
+
+    Args:
+        version: version of the parser
+        inputs: digests of the content of the inputs (see file_digest, or a checksum published with the data)
+    Returns:
+        The key of the cache entry
+    """
+    digest = hashlib.sha256(str(version).encode())
+    for value in inputs:
+        digest.update(b"\0" + str(value).encode())
+    return digest.hexdigest()
+
+
+def entry_path(source: str, key: str):
+    return os.path.join(folder, source, key)
+
+
+def fetch(source: str, key: str, output_files: list, logger):
+    """
+    Copy the files of a cache entry to their destination
+
+    Args:
+        source: name of the source (explorenz, sprot...)
+        key: key of the entry (see entry_key)
+        output_files: names and paths of the files to restore
+    Returns:
+        True if the entry was found and restored, False otherwise
+    """
+    if not max_size or not key:
+        return False
+    path = entry_path(source, key)
+    if not os.path.isdir(path):
+        return False
+    try:
+        for output_file in output_files:
+            shutil.copyfile(os.path.join(path, os.path.basename(output_file)), output_file)
+        # the modification time of the entry is its last use
+        os.utime(path)
+    except OSError as e:
+        logger.warning(f"Could not restore the cache entry {path}: {e}")
+        return False
+    logger.info(f"{source} parsed data restored from the cache")
+    return True
+
+
+def store(source: str, key: str, version: str, output_files: list, logger):
+    """
+    Copy the parsed files to a new cache entry. The entries of the source made
+    by another version of the parser are removed, then the least recently used
+    entries are evicted until the cache fits in its maximum size.
+
+    Args:
+        source: name of the source (explorenz, sprot...)
+        key: key of the entry (see entry_key)
+        version: version of the parser
+        output_files: names and paths of the parsed files
+    """
+    if not max_size or not key:
+        return
+    path = entry_path(source, key)
+    # written aside then renamed, so that a concurrent job never sees a partial entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        for output_file in output_files:
+            shutil.copyfile(output_file, os.path.join(tmp_path, os.path.basename(output_file)))
+        with open(os.path.join(tmp_path, "entry.json"), "w") as f:
+            json.dump({"version": str(version), "created": time.time()}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not store the cache entry {path}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+    for name in os.listdir(os.path.join(folder, source)):
+        entry = os.path.join(folder, source, name)
+        try:
+            with open(os.path.join(entry, "entry.json"), "r") as f:
+                entry_version = json.load(f)["version"]
+        except (OSError, ValueError, KeyError):
+            continue
+        if entry_version != str(version):
+            logger.info(f"Removing the cache entry {entry} of the parser version {entry_version}")
+            shutil.rmtree(entry, ignore_errors=True)
+    evict(logger)
+
+
+def evict(logger):
+    """
+    Remove the least recently used entries until the cache fits in its maximum size
+    """
+    entries = []
+    total = 0
+    for source in os.listdir(folder):
+        if not os.path.isdir(os.path.join(folder, source)):
+            continue
+        for name in os.listdir(os.path.join(folder, source)):
+            entry = os.path.join(folder, source, name)
+            if name.endswith(".tmp"):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total += size
+    for mtime, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        logger.info(f"Evicting the cache entry {entry}")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def cached(source: str, version: str, inputs: list, output_files: list, function, logger, force=False):
+    """
+    Run a parsing function unless its result for the same inputs and parser version is in the cache
+
+    Args:
+        source: name of the source (explorenz, sprot...)
+        version: version of the parser
+        inputs: digests of the content of the inputs
+        output_files: names and paths of the files written by function
+        function: function without argument doing the parsing
+        force: run function even if its result is in the cache, the cache entry is then replaced
+    Returns:
+        True if the result came from the cache, False if function was run
+    """
+    key = entry_key(version, inputs)
+    if not force and fetch(source, key, output_files, logger):
+        return True
+    function()
+    if all(os.path.exists(output_file) for output_file in output_files):
+        store(source, key, version, output_files, logger)
+    return False
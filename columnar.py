@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+import heapq
+import os
+import shutil
+import sys
+from operator import itemgetter
+import pyarrow as pa
+import pyarrow.ipc
+
+# number of rows of a record batch
+BATCH_SIZE = 1 << 16
+
+kinetic = pa.list_(pa.struct([("value", pa.string()), ("substrate", pa.string())]))
+
+# typed schema of the parsed data of each source, one row per (key, value) pair
+SCHEMAS = {
+    "uniprot": pa.schema([
+        ("accession", pa.string()),
+        ("ec_number", pa.string()),
+        ("complete", pa.bool_()),
+    ]),
+    "explorenz_ec": pa.schema([
+        ("ec_number", pa.string()),
+        ("accepted_name", pa.string()),
+        ("reaction", pa.string()),
+        ("other_names", pa.string()),
+        ("sys_name", pa.string()),
+        ("comments", pa.string()),
+        ("links", pa.string()),
+        ("class", pa.int32()),
+        ("subclass", pa.int32()),
+        ("subsubclass", pa.int32()),
+        ("serial", pa.string()),
+        ("status", pa.string()),
+        ("diagram", pa.string()),
+        ("cas_num", pa.string()),
+        ("glossary", pa.string()),
+        ("last_change", pa.string()),
+        ("id", pa.string()),
+        ("created", pa.string()),
+    ]),
+    "explorenz_nomenclature": pa.schema([
+        ("ec_number", pa.string()),
+        ("heading", pa.string()),
+        ("first_number", pa.int32()),
+        ("second_number", pa.int32()),
+        ("third_number", pa.int32()),
+    ]),
+    "brenda": pa.schema([
+        ("ec_number", pa.string()),
+        ("species", pa.list_(pa.string())),
+        ("cofactors", pa.list_(pa.string())),
+        ("km_value", kinetic),
+        ("turnover_number", kinetic),
+        ("specific_activity", kinetic),
+    ]),
+    "kegg": pa.schema([
+        ("pathway_class", pa.string()),
+        ("pathway", pa.string()),
+        ("ec_number", pa.string()),
+    ]),
+    "pdb": pa.schema([
+        ("ec_number", pa.string()),
+        ("pdb_id", pa.string()),
+        ("uniprot_accession", pa.string()),
+        ("entity_id", pa.string()),
+    ]),
+}
+
+
+def integer(value):
+    return None if value in (None, "") else int(value)
+
+
+def entry_rows(source: str, key, value):
+    """
+    Flatten one entry of the parsed data of a source into rows of its schema
+
+    Args:
+        source: name of the schema (see SCHEMAS)
+        key, value: the key and the value of the entry in the parsed data
+    Yield:
+        tuples in the order of the columns of the schema
+    """
+    if source == "uniprot":
+        # data structure : {accession: {"ec_numbers": [(ec_number, complete)]}}
+        for ec_number, complete in value["ec_numbers"]:
+            yield key, ec_number, complete
+    elif source == "explorenz_ec":
+        yield (key,) + tuple(
+            integer(value.get(name)) if name in ("class", "subclass", "subsubclass") else value.get(name)
+            for name in SCHEMAS[source].names[1:]
+        )
+    elif source == "explorenz_nomenclature":
+        yield (key, value["heading"], integer(value["first_number"]),
+               integer(value["second_number"]), integer(value["third_number"]))
+    elif source == "brenda":
+        yield (key, value["species"], value.get("cofactors", [])) + tuple(
+            [{"value": kinetic_value, "substrate": substrate} for kinetic_value, substrate in value.get(name, [])]
+            for name in ("km_value", "turnover_number", "specific_activity")
+        )
+    elif source == "kegg":
+        # data structure : {pathway class: {pathway: [ec_number]}}
+        for pathway in sorted(value):
+            for ec_number in value[pathway]:
+                yield key, pathway, ec_number
+    elif source == "pdb":
+        # data structure : {ec_number: [(pdb id, uniprot accession, entity id)]}
+        for values in sorted(value):
+            yield (key,) + tuple(values) + ("",) * (3 - len(values))
+    else:
+        raise ValueError(f"Unknown source {source}")
+
+
+def to_rows(source: str, data: dict):
+    """
+    Flatten the parsed data of a source into the rows of its schema, sorted by key
+
+    Args:
+        source: name of the schema (see SCHEMAS)
+        data: the parsed data, as built by the parse functions
+    Yield:
+        tuples in the order of the columns of the schema
+    """
+    for key in sorted(data):
+        yield from entry_rows(source, key, data[key])
+
+
+def write_rows(source: str, rows, output_file: str, logger, batch_size=BATCH_SIZE):
+    """
+    Write rows to an Arrow IPC file, batch by batch so that the rows are never all in memory.
+    The file is written aside and renamed once complete.
+
+    Args:
+        source: name of the schema (see SCHEMAS)
+        rows: iterable of tuples in the order of the columns of the schema
+        output_file: name and path of the output file
+        batch_size: number of rows of a record batch
+    Returns:
+        The number of rows written
+    """
+    schema = SCHEMAS[source].with_metadata({"source": source})
+    tmp_file = output_file + ".tmp"
+    count = 0
+    try:
+        with pa.OSFile(tmp_file, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    writer.write_batch(record_batch(schema, batch))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_batch(record_batch(schema, batch))
+                count += len(batch)
+        os.replace(tmp_file, output_file)
+    except Exception as e:
+        logger.exception(f"Error occurred while saving table file: {e}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return count
+
+
+def record_batch(schema, rows: list):
+    columns = zip(*rows)
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema
+    )
+
+
+def save(source: str, data: dict, output_file: str, logger):
+    """
+    This function stores the parsed data of a source as an Arrow IPC file.
+    Args:
+        source: name of the schema (see SCHEMAS)
+        data: the parsed data, as built by the parse functions
+        output_file: name and path of the output file
+    """
+    write_rows(source, to_rows(source, data), output_file, logger)
+
+
+def read_batches(input_file: str):
+    """
+    Memory-map an Arrow IPC file and yield its record batches
+
+    Args:
+        input_file: name and path of the file
+    Yield:
+        pyarrow.RecordBatch
+    """
+    with pa.memory_map(input_file, "r") as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def read_rows(input_file: str, logger, columns=None):
+    """
+    Iterate over the rows of an Arrow IPC file, only one record batch is converted at a time
+
+    Args:
+        input_file: name and path of the file
+        columns: names of the columns to read, in this order (all of them if not set)
+    Yield:
+        tuples in the order of the columns of the schema
+    """
+    try:
+        for batch in read_batches(input_file):
+            names = columns or batch.schema.names
+            yield from zip(*(batch.column(name).to_pylist() for name in names))
+    except (OSError, KeyError, pa.ArrowInvalid) as e:
+        logger.exception(f"Error occurred while loading table file: {e}")
+
+
+# number of leading columns the rows of a source are sorted on (see to_rows)
+SORT_COLUMNS = {
+    "uniprot": 1,
+    "explorenz_ec": 1,
+    "explorenz_nomenclature": 1,
+    "brenda": 1,
+    "kegg": 2,
+    "pdb": 4,
+}
+# rows of a record batch of the sorted runs, small so that merging many runs needs little memory
+RUN_BATCH_SIZE = 1 << 12
+# maximum number of runs merged at once
+MAX_FAN_IN = 64
+# one row out of SIZE_SAMPLE is measured, the others are counted at the average size of the measured rows
+SIZE_SAMPLE = 1 << 10
+
+
+def row_size(value):
+    """
+    Returns:
+        Rough size in memory of a row (tuple, list, dict and scalars)
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(row_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(row_size(item) for item in value.values())
+    return size
+
+
+class SpillBuffer:
+    """
+    Collect the rows of a source and write them sorted by key, as to_rows does.
+    When the rows held in memory exceed the memory budget, they are sorted and written
+    to a run file; the runs are merged (k-way, stable) into the output file at the end.
+    Rows with the same key keep the order in which they were added. Unlike a dictionary, an entry
+    added twice is not replaced, the keys of the sources (accessions, ec numbers) being unique.
+    """
+
+    def __init__(self, source: str, output_file: str, logger, memory_budget=None):
+        """
+        Args:
+            source: name of the schema (see SCHEMAS)
+            output_file: name and path of the output file, the runs are written in output_file.runs/
+            memory_budget: size in bytes of the rows held in memory, unlimited if None
+        """
+        self.source = source
+        self.output_file = output_file
+        self.logger = logger
+        self.memory_budget = memory_budget
+        self.key = itemgetter(*range(SORT_COLUMNS[source]))
+        self.rows = []
+        self.added = 0
+        self.measured = 0
+        self.measured_size = 0
+        self.row_estimate = 0
+        self.runs = []
+        self.run_folder = output_file + ".runs"
+
+    def add(self, row):
+        self.rows.append(row)
+        if self.memory_budget:
+            if not self.added % SIZE_SAMPLE:
+                self.measured += 1
+                self.measured_size += row_size(row)
+                self.row_estimate = self.measured_size / self.measured
+            self.added += 1
+            if len(self.rows) * self.row_estimate >= self.memory_budget:
+                self.spill()
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def spill(self):
+        """Write the rows held in memory to a new sorted run"""
+        if not self.rows:
+            return
+        os.makedirs(self.run_folder, exist_ok=True)
+        run = os.path.join(self.run_folder, f"{len(self.runs):06d}.arrow")
+        self.rows.sort(key=self.key)
+        write_rows(self.source, self.rows, run, self.logger, batch_size=RUN_BATCH_SIZE)
+        self.runs.append(run)
+        self.rows = []
+
+    def dump(self):
+        """
+        Write the rows held in memory to a last run, e.g. in a worker process whose runs are adopted by another buffer
+
+        Returns:
+            The names of the runs, sorted from the earliest
+        """
+        self.spill()
+        runs = self.runs
+        self.runs = []
+        return runs
+
+    def adopt(self, runs: list):
+        """
+        Take the runs written by other buffers of the same source (see dump), after the runs of this one.
+        They are merged and removed by close.
+        """
+        self.spill()
+        self.runs.extend(runs)
+
+    def merge(self, runs: list):
+        return heapq.merge(*(read_rows(run, self.logger) for run in runs), key=self.key)
+
+    def close(self):
+        """
+        Write the output file and remove the runs
+
+        Returns:
+            The number of rows written
+        """
+        if not self.runs:
+            self.rows.sort(key=self.key)
+            count = write_rows(self.source, self.rows, self.output_file, self.logger)
+            self.rows = []
+            return count
+        self.spill()
+        self.logger.info(f"Merging {len(self.runs)} sorted runs")
+        folders = {os.path.dirname(run) for run in self.runs} | {self.run_folder}
+        # the earliest runs are merged first so that the order of the rows with the same key is kept
+        while len(self.runs) > MAX_FAN_IN:
+            run = os.path.join(self.run_folder, f"merged_{len(self.runs):06d}.arrow")
+            write_rows(self.source, self.merge(self.runs[:MAX_FAN_IN]), run, self.logger, batch_size=RUN_BATCH_SIZE)
+            for merged in self.runs[:MAX_FAN_IN]:
+                os.remove(merged)
+            self.runs = [run] + self.runs[MAX_FAN_IN:]
+        count = write_rows(self.source, self.merge(self.runs), self.output_file, self.logger)
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+        self.runs = []
+        return count
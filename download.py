@@ -1,32 +1,241 @@
 from ftplib import FTP
-import sys
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import json
+import threading
+import zlib
+import xml.etree.ElementTree as ET
 import requests
 import os
 from bs4 import BeautifulSoup
 import logging
-from time import sleep
+from time import sleep, monotonic
+import scheduler
+import utils
+
+# size of the reads and writes of the large downloads
+BUFFER_SIZE = 1 << 20
+
+
+class Verifier:
+    """
+    Check a download while its bytes arrive: md5 and size are computed, and if it is a gzip file
+    it is decompressed (output discarded) to check that every member is complete and has a valid CRC.
+
+    Args:
+        gzip_check: check the gzip integrity
+    """
+
+    def __init__(self, gzip_check=True):
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.gzip_check = gzip_check
+        self.decompressor = None
+        self.gzip_error = None
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        if not self.gzip_check or self.gzip_error:
+            return
+        data = chunk
+        try:
+            while data:
+                if self.decompressor is None:  # start of a gzip member
+                    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.decompressor.decompress(data, BUFFER_SIZE)
+                data = self.decompressor.unconsumed_tail
+                if self.decompressor.eof:
+                    data = self.decompressor.unused_data
+                    self.decompressor = None
+        except zlib.error as e:
+            self.gzip_error = f"invalid gzip data: {e}"
+
+    def error(self, expected=None):
+        """
+        Args:
+            expected: dictionary with the "md5" and/or "size" published upstream
+        Returns:
+            None if the download is valid, the reason why it is not otherwise
+        """
+        if self.gzip_error:
+            return self.gzip_error
+        if self.gzip_check and (self.size == 0 or self.decompressor is not None):
+            return "truncated gzip data"
+        expected = expected or {}
+        if "size" in expected and int(expected["size"]) != self.size:
+            return f"size {self.size} instead of {expected['size']}"
+        if "md5" in expected and expected["md5"].lower() != self.md5.hexdigest():
+            return f"md5 {self.md5.hexdigest()} instead of {expected['md5']}"
+        return None
+
+
+class VerifiedStream:
+    """
+    Wrap a binary stream to feed a Verifier with the bytes read from it
+    (the gzip integrity is left to the reader, e.g. gzip.GzipFile checks it)
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.verifier = Verifier(gzip_check=False)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.verifier.update(data)
+        return data
+
+
+def verify_file(local_file, logger, expected=None, gzip_check=None):
+    """
+    Check the integrity of a downloaded file (see Verifier).
+    Args:
+        local_file: name and location of the file
+        expected: dictionary with the "md5" and/or "size" published upstream
+        gzip_check: check the gzip integrity, if None only for the files ending with .gz
+    Returns:
+        True if the file is valid, False otherwise
+    """
+    if gzip_check is None:
+        gzip_check = local_file.endswith(".gz")
+    verifier = Verifier(gzip_check=gzip_check)
+    with open(local_file, "rb") as f:
+        while chunk := f.read(BUFFER_SIZE):
+            verifier.update(chunk)
+    error = verifier.error(expected)
+    if error:
+        logger.error(f"Integrity check failed for {local_file}: {error}")
+        return False
+    return True
+
+
+def quarantine_path(local_file, folder=None):
+    """
+    Args:
+        local_file: name and location of the file
+        folder: quarantine folder, "quarantine" next to the file if None
+    Returns:
+        The name and location of the quarantined copy of the file
+    """
+    return os.path.join(folder or os.path.join(os.path.dirname(local_file), "quarantine"), os.path.basename(local_file))
+
+
+def quarantine(local_file, logger, folder=None):
+    """
+    Move a corrupt file to a quarantine folder, so that it is fetched again. Only the last corrupt
+    copy of a file is kept, it is removed once the file is downloaded again (see release_quarantine).
+    Args:
+        local_file: name and location of the file
+        folder: quarantine folder, "quarantine" next to the file if None
+    """
+    target = quarantine_path(local_file, folder)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(local_file, target)
+    for leftover in (local_file + ".progress",):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    logger.warning(f"{local_file} moved to {target}")
+
+
+def release_quarantine(local_file, logger, folder=None):
+    """
+    Remove the quarantined copy of a file once it was downloaded again and checked.
+    Args:
+        local_file: name and location of the file
+        folder: quarantine folder, "quarantine" next to the file if None
+    """
+    target = quarantine_path(local_file, folder)
+    if os.path.exists(target):
+        os.remove(target)
+        logger.info(f"{target} removed, {local_file} is valid")
+
+
+def verified(fetch, local_file, logger, expected=None, attempts=3, quarantine_folder=None, gzip_check=None):
+    """
+    Download a file and check it, quarantining it and downloading it again if it is corrupt.
+    Args:
+        fetch: function downloading the file to local_file, returning True if the download was successful
+        local_file: name and location of the file
+        expected: dictionary with the "md5" and/or "size" published upstream
+        attempts: number of downloads before giving up
+        quarantine_folder: folder of the corrupt copies, "quarantine" next to the file if None
+        gzip_check: check the gzip integrity, if None only for the files ending with .gz
+    Returns:
+        True if a valid file was downloaded, False otherwise
+    """
+    for i in range(attempts):
+        if not fetch():
+            return False
+        if verify_file(local_file, logger, expected, gzip_check):
+            release_quarantine(local_file, logger, quarantine_folder)
+            return True
+        quarantine(local_file, logger, quarantine_folder)
+    return False
+
+
+def uniprot_checksums(ftp_host: str, remote_file: str, logger, ftp_user="anonymous", ftp_passwd="anonymous@"):
+    """
+    Get the size and md5 of the files of a uniprot release from its RELEASE.metalink file.
+    Args:
+        ftp_host: Name of the host
+        remote_file: path to the metalink file excluding the ftp_host name
+    Returns:
+        Dictionary {file name: {"size", "md5"}}, empty if the metalink could not be read
+    """
+    try:
+        with scheduler.get_scheduler().slot(ftp_host):
+            ftp = FTP(ftp_host)
+            ftp.login(user=ftp_user, passwd=ftp_passwd)
+            chunks = []
+            ftp.retrbinary("RETR " + remote_file, chunks.append)
+            ftp.quit()
+        root = ET.fromstring(b"".join(chunks))
+    except Exception as e:
+        logger.exception(f"Could not read the checksums: {e}")
+        return {}
+    checksums = {}
+    for element in root.iter():
+        if element.tag.endswith("}file") or element.tag == "file":
+            checksum = {}
+            for child in element.iter():
+                if child.tag.split("}")[-1] == "size":
+                    checksum["size"] = child.text.strip()
+                if child.tag.split("}")[-1] == "hash" and child.get("type") == "md5":
+                    checksum["md5"] = child.text.strip()
+            checksums[element.get("name")] = checksum
+    return checksums
 
 
 # TODO: delete or https
-def http(url, filename, logger):
+def http(url, filename, logger, quarantine_folder=None):
     """
     Downloads a file from the specified URL and saves it with the given filename (using http link).
 
     Args:
         url: The URL of the file to download.
         local_file: The name of the file to save the downloaded content as.
+        quarantine_folder: folder of the corrupt copies, "quarantine" next to the file if None
 
     Returns:
         True if the download was successful, False otherwise.
     """
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Raise an exception for non-200 status codes
+        verifier = Verifier(gzip_check=filename.endswith(".gz"))
+        with scheduler.get_scheduler().stream("GET", url, stream=True) as response:
+            response.raise_for_status()  # Raise an exception for non-200 status codes
 
-        with open(filename, "wb") as file:
-            for chunk in response.iter_content(1024):
-                if chunk:
-                    file.write(chunk)
+            with open(filename, "wb") as file:
+                for chunk in response.iter_content(BUFFER_SIZE):
+                    if chunk:
+                        file.write(chunk)
+                        verifier.update(chunk)
+        error = verifier.error()
+        if error:
+            logger.error(f"Integrity check failed for {url}: {error}")
+            quarantine(filename, logger, quarantine_folder)
+            return False
+        release_quarantine(filename, logger, quarantine_folder)
         return True
 
     except requests.exceptions.RequestException as e:
@@ -34,63 +243,288 @@ def http(url, filename, logger):
         return False
 
 
-def ftp(
+def http_fingerprint(url, logger):
+    """
+    Get the fingerprint of a remote file without downloading it.
+
+    Args:
+        url: The URL of the file.
+
+    Returns:
+        Dictionary of the ETag/Last-Modified validators, None if the server sends none.
+    """
+    try:
+        response = scheduler.get_scheduler().request("HEAD", url, allow_redirects=True)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.exception(e)
+        return None
+    fingerprint = utils.response_fingerprint(response)
+    if "ETag" not in fingerprint and "Last-Modified" not in fingerprint:
+        return None
+    return fingerprint
+
+
+def ftp_fingerprint(
+    ftp_host: str,
+    remote_file: str,
+    logger,
+    ftp_user="anonymous",
+    ftp_passwd="anonymous@",
+):
+    """
+    Get the fingerprint of a release from a small text file describing it (e.g. uniprot reldate.txt)
+
+    Args:
+        ftp_host: Name of the host
+        remote_file: path to the release file excluding the ftp_host name
+    Returns:
+        Dictionary with the content of the release file, None if it could not be read.
+    """
+    try:
+        with scheduler.get_scheduler().slot(ftp_host):
+            ftp = FTP(ftp_host)
+            ftp.login(user=ftp_user, passwd=ftp_passwd)
+            lines = []
+            ftp.retrlines("RETR " + remote_file, lines.append)
+            ftp.quit()
+    except Exception as e:
+        logger.exception(f"Ftp exception: {e}")
+        return None
+    return {"release": "\n".join(line.strip() for line in lines)}
+
+
+def segmented_download(
+    local_file: str,
+    size: int,
+    validator: str,
+    read_range,
+    logger,
+    connections=4,
+    segment_size=1 << 28,
+    retries=5,
+    backoff_factor=2,
+):
+    """
+    Download a file as segments fetched in parallel, each written in place with os.pwrite.
+    The progress is saved in local_file.progress, so that an interrupted download resumes where it stopped
+    (a progress saved for another version of the remote file is discarded).
+
+    Args:
+        local_file: name and location of the downloaded file
+        size: size of the remote file in bytes
+        validator: string identifying the version of the remote file (e.g. ETag or modification time)
+        read_range: function (start, end) returning an iterator over the bytes of the remote file from start to end (excluded)
+        connections: number of segments downloaded at the same time
+        segment_size: size of the segments in bytes
+        retries: number of attempts for each segment
+        backoff_factor: time factor for exponential backoff between attempts
+    Returns:
+        True if the download was successful, False otherwise.
+    """
+    progress_file = local_file + ".progress"
+    progress = None
+    if os.path.exists(progress_file) and os.path.exists(local_file):
+        try:
+            with open(progress_file, "r") as f:
+                progress = json.load(f)
+        except ValueError:
+            progress = None
+        if progress and (progress["size"], progress["validator"]) != (size, validator):
+            logger.info("Remote file changed since the interrupted download, starting over")
+            progress = None
+    if progress is None:
+        progress = {
+            "size": size,
+            "validator": validator,
+            "segment_size": segment_size,
+            "done": {str(start): 0 for start in range(0, size, segment_size)},
+        }
+    else:
+        logger.info(f"Resuming download, {sum(progress['done'].values())}/{size} bytes already downloaded")
+    segment_size = progress["segment_size"]
+    lock = threading.Lock()
+    last_save = [monotonic()]
+
+    def save_progress(every=5):
+        # called with the lock held
+        if monotonic() - last_save[0] < every:
+            return
+        os.fsync(fd)  # the data must be on disk before the progress claims it is
+        with open(progress_file + ".tmp", "w") as f:
+            json.dump(progress, f)
+        os.replace(progress_file + ".tmp", progress_file)
+        last_save[0] = monotonic()
+
+    def fetch(start):
+        end = min(start + segment_size, size)
+        for i in range(retries):
+            offset = start + progress["done"][str(start)]
+            if offset >= end:
+                return True
+            try:
+                for chunk in read_range(offset, end):
+                    view = memoryview(chunk)
+                    while view:
+                        written = os.pwrite(fd, view, offset)
+                        view = view[written:]
+                        offset += written
+                    with lock:
+                        progress["done"][str(start)] = offset - start
+                        save_progress()
+                if offset >= end:
+                    return True
+                raise EOFError(f"Connection closed at byte {offset}")
+            except Exception as e:
+                logger.warning(f"Attempt {i+1} failed for segment {start}-{end}: {e}")
+                sleep(backoff_factor * (2**i))
+        return False
+
+    fd = os.open(local_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        pending = [int(start) for start, done in progress["done"].items() if int(start) + done < min(int(start) + segment_size, size)]
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            results = list(executor.map(fetch, pending))
+    finally:
+        with lock:
+            save_progress(every=0)
+        os.close(fd)
+
+    if all(results):
+        os.remove(progress_file)
+        return True
+    logger.error(f"Download incomplete, {sum(progress['done'].values())}/{size} bytes downloaded, rerun to resume")
+    return False
+
+
+def segmented_ftp(
     ftp_host: str,
     remote_file: str,
     local_file: str,
     logger,
+    connections=4,
+    segment_size=1 << 28,
     ftp_user="anonymous",
     ftp_passwd="anonymous@",
 ):
     """
-    Download a file from the specified URL using the ftp protocol
+    Download a large file over several ftp connections, each starting at its segment with REST
+    (see segmented_download).
 
     Args:
         ftp_host: Name of the host
         remote_file: path to the remote file excluding the ftp_host name
         local_file: name and location of the downloaded file
+        connections: number of connections used at the same time
+    Returns:
+        True if the download was successful, False otherwise.
+    """
+    try:
+        with scheduler.get_scheduler().slot(ftp_host):
+            ftp = FTP(ftp_host)
+            ftp.login(user=ftp_user, passwd=ftp_passwd)
+            ftp.voidcmd("TYPE I")
+            size = ftp.size(remote_file)
+            try:
+                validator = ftp.sendcmd("MDTM " + remote_file)
+            except Exception:
+                validator = ""
+            ftp.quit()
+    except Exception as e:
+        logger.exception(f"Ftp exception: {e}")
+        return False
+
+    def read_range(start, end):
+        with scheduler.get_scheduler().slot(ftp_host):
+            ftp = FTP(ftp_host)
+            try:
+                ftp.login(user=ftp_user, passwd=ftp_passwd)
+                ftp.voidcmd("TYPE I")
+                conn = ftp.transfercmd("RETR " + remote_file, rest=start)
+                with conn, conn.makefile("rb", buffering=BUFFER_SIZE) as stream:
+                    remaining = end - start
+                    while remaining > 0:
+                        chunk = stream.read(min(BUFFER_SIZE, remaining))
+                        if not chunk:
+                            return
+                        remaining -= len(chunk)
+                        yield chunk
+            finally:
+                ftp.close()  # the transfer is cut at the end of the segment, no need to wait for the server
+
+    return segmented_download(
+        local_file, size, validator, read_range, logger, connections=connections, segment_size=segment_size
+    )
+
+
+@contextmanager
+def ftp_stream(
+    ftp_host: str,
+    remote_file: str,
+    logger,
+    ftp_user="anonymous",
+    ftp_passwd="anonymous@",
+):
+    """
+    Open a remote file using the ftp protocol and give its content as a binary stream,
+    to be consumed while it is transferred instead of saving it first.
+
+    Args:
+        ftp_host: Name of the host
+        remote_file: path to the remote file excluding the ftp_host name
         ftp_user: name to use if needed to connect, anonymous by default
         ftp_passwd: password to use if needed to connect, anonymous@ by default
+    Yield:
+        binary file object reading from the data connection
     """
-    try:
-        # Connect to the FTP server
+    with scheduler.get_scheduler().slot(ftp_host):
         ftp = FTP(ftp_host)
         ftp.login(user=ftp_user, passwd=ftp_passwd)
-
-        # Download the file
-        with open(local_file, "wb") as local_fp:
-            ftp.retrbinary("RETR " + remote_file, local_fp.write)
-
-        # Close the FTP connection
-        ftp.quit()
-    except Exception as e:
-        logger.exception("Ftp exception: ", e)
-        sys.exit(1)
+        ftp.voidcmd("TYPE I")
+        conn = ftp.transfercmd("RETR " + remote_file)
+        stream = conn.makefile("rb")
+        try:
+            yield stream
+        except Exception:
+            stream.close()
+            conn.close()
+            ftp.close()
+            raise
+        stream.close()
+        conn.close()
+        try:
+            ftp.voidresp()
+            ftp.quit()
+        except Exception as e:
+            logger.warning(f"Ftp exception while closing the transfer: {e}")
+            ftp.close()
 
 
 # PDB
-def retry_request(url, retries=3, backoff_factor=0.3):
+def retry_request(url, retries=3, backoff_factor=0.3, session=None):
     """
-    Make a GET request to a URL with retries.
+    Make a GET request to a URL with retries (see scheduler.Scheduler.stream).
     Args:
         url: URL to make request to.
         retries: Number of retries.
         backoff_factor: Time factor for exponential backoff.
+        session: Session to use, the scheduler session if None.
     Returns:
         Response object if successful, None otherwise.
     """
-    for i in range(retries):
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            return response
-        except requests.RequestException as e:
-            logging.error(f"Attempt {i+1} failed for URL {url}: {e}")
-            sleep(backoff_factor * (2**i))
-    return None
+    try:
+        response = scheduler.get_scheduler().request(
+            "GET", url, retries=retries, backoff_factor=backoff_factor, session=session
+        )
+        response.raise_for_status()
+        return response
+    except requests.RequestException as e:
+        logging.error(f"Request failed for URL {url}: {e}")
+        return None
 
 
-def pdb_get_subfolder(url: str):
+def pdb_get_subfolder(url: str, session=None):
     """
     Get a list of the links (url) on the page.
     Args:
@@ -98,7 +532,7 @@ def pdb_get_subfolder(url: str):
     Returns:
         List of subfolder names.
     """
-    response = retry_request(url)
+    response = retry_request(url, session=session)
     if response:
         html_data = response.content
         parsed_data = BeautifulSoup(html_data, "html.parser")
@@ -108,37 +542,181 @@ def pdb_get_subfolder(url: str):
     return []
 
 
-def pdb_download_subfolder(base_url: str, output_path: str, folder: str):
+def pdb_list_subfolder(base_url: str, folder: str, session=None):
     """
-    Download all the content contained in the specified subfolder.
+    List the xml.gz files of a subfolder with the date and size displayed in the listing.
     Args:
         base_url: The page containing the subfolder.
+        folder: Name of the folder to list.
+    Returns:
+        Dictionary {file name: (remote mtime, size)}, None if the listing could not be fetched.
+    """
+    response = retry_request(os.path.join(base_url, folder), session=session)
+    if not response:
+        return None
+    parsed_data = BeautifulSoup(response.content, "html.parser")
+    listing = {}
+    for link in parsed_data.find_all("a", href=True):
+        if link["href"].endswith("xml.gz"):
+            # apache listing: <a href="100d.xml.gz">100d.xml.gz</a>   2024-02-07 09:49   18K
+            details = link.next_sibling.split() if isinstance(link.next_sibling, str) else []
+            listing[link["href"]] = (" ".join(details[:-1]), details[-1] if details else "")
+    return listing
+
+
+def pdb_fingerprint(listings: dict):
+    """
+    Summarize the listings of all the subfolders in a single fingerprint.
+    Args:
+        listings: Dictionary {folder: listing} as returned by pdb_list_subfolder.
+    Returns:
+        Dictionary with the number of files and a hash of the names, dates and sizes,
+        None if a listing is missing.
+    """
+    if not listings or any(listing is None for listing in listings.values()):
+        return None
+    digest = hashlib.sha256()
+    count = 0
+    for folder in sorted(listings):
+        for name in sorted(listings[folder]):
+            mtime, size = listings[folder][name]
+            digest.update(f"{folder}{name} {mtime} {size}\n".encode())
+            count += 1
+    return {"files": count, "listing_sha256": digest.hexdigest()}
+
+
+def pdb_changes(manifest: dict, listings: dict, version=None):
+    """
+    Compare the local manifest with the remote listings.
+    Args:
+        manifest: Dictionary {"folder/file name": {"mtime", "size", "version", "pdb_ids"}} of the files already parsed.
+        listings: Dictionary {folder: listing} as returned by pdb_list_subfolder.
+        version: Version of the parser, the files parsed by another version are considered changed.
+    Returns:
+        (changed, withdrawn): the files that are new or whose mtime, size or parser version changed,
+        and the files of the manifest that are no longer listed.
+        Files of a folder whose listing failed are neither changed nor withdrawn.
+    """
+    changed = []
+    remote = set()
+    for folder, listing in listings.items():
+        for name, (mtime, size) in (listing or {}).items():
+            path = folder + name
+            remote.add(path)
+            entry = manifest.get(path)
+            if not entry or (entry["mtime"], entry["size"], entry.get("version")) != (mtime, size, version):
+                changed.append(path)
+    withdrawn = [
+        path for path in manifest
+        if path not in remote and listings.get(path.split("/")[0] + "/", {}) is not None
+    ]
+    return changed, withdrawn
+
+
+def pdb_jobs(base_url: str, output_path: str, files: list):
+    """
+    Create the local subfolders and yield the files to download.
+    Args:
+        base_url: The page containing the subfolders.
         output_path: Path where the folders will be downloaded.
-        folder: Name of the folder to download.
+        files: "folder/file name" of the files to download.
+    Yield:
+        (url, local path) of each file
     """
-    subfolder_url = os.path.join(base_url, folder)
-    subfolder_name = folder.rstrip("/")
-    full_subfolder_path = os.path.join(output_path, subfolder_name)
+    for path in files:
+        local_path = os.path.join(output_path, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        yield os.path.join(base_url, path), local_path
 
-    if not os.path.exists(full_subfolder_path):
-        os.makedirs(full_subfolder_path)
 
-    response = retry_request(subfolder_url)
-    if response:
-        html_data = response.content
-        parsed_data = BeautifulSoup(html_data, "html.parser")
-        links = parsed_data.find_all("a", href=True)
+def download_file(url, local_path, logger, session=None, retries=3, backoff_factor=0.3, chunk_size=1 << 16,
+                  quarantine_folder=None):
+    """
+    Download a file, streaming the body to disk. The file only appears under local_path once complete
+    and checked (see verified), a corrupt download is quarantined and fetched again. The request is
+    retried by the scheduler (see scheduler.Scheduler.stream), a file that fails is fetched again on the next run.
+    Args:
+        url: URL of the file.
+        local_path: Name and path of the downloaded file.
+        session: Session to use, the scheduler session if None.
+        retries: Number of attempts of the request.
+        backoff_factor: Time factor for exponential backoff.
+        quarantine_folder: folder of the corrupt copies, "quarantine" next to the file if None
+    Returns:
+        True if the download was successful, False otherwise.
+    """
+    partial_path = local_path + ".part"
 
-        for link in links:
-            if link["href"].endswith("xml.gz"):
-                full_url = os.path.join(subfolder_url, link["href"])
-                full_name = os.path.join(full_subfolder_path, link["href"])
-                download_file(full_url, full_name)
+    def fetch():
+        try:
+            with scheduler.get_scheduler().stream(
+                "GET", url, retries=retries, backoff_factor=backoff_factor, session=session, stream=True
+            ) as response:
+                response.raise_for_status()
+                with open(partial_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+            return True
+        except (requests.RequestException, OSError) as e:
+            logger.error(f"Download failed for URL {url}: {e}")
+            return False
 
+    # the partial file is checked as the file it becomes
+    if verified(fetch, partial_path, logger, quarantine_folder=quarantine_folder, gzip_check=local_path.endswith(".gz")):
+        os.replace(partial_path, local_path)
+        return True
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    return False
 
-def download_file(url, local_path):
-    response = retry_request(url)
-    if response:
-        with open(local_path, "wb") as f:
-            f.write(response.content)
-        logging.info(f"Downloaded {url} to {local_path}")
+
+def download_files(jobs, logger, worker=16, queue_size=None, session=None, quarantine_folder=None):
+    """
+    Download many files with a fixed pool of threads sharing keep-alive connections.
+    The jobs are consumed lazily: at most queue_size downloads are pending at any time.
+    The number of requests sent at once to a host is further limited by the scheduler.
+    Args:
+        jobs: Iterable of (url, local path).
+        worker: Number of threads.
+        queue_size: Maximum number of pending downloads, 2 * worker by default.
+        session: Session to use, the scheduler session if None.
+        quarantine_folder: folder of the corrupt copies, "quarantine" next to the files if None
+    Returns:
+        List of the (url, local path) that could not be downloaded.
+    """
+    queue_size = queue_size or 2 * worker
+    failed = []
+    downloaded = 0
+
+    def collect(done):
+        nonlocal downloaded
+        for future in done:
+            job = pending.pop(future)
+            try:
+                success = future.result()
+            except Exception as e:
+                logger.error(f"Download of {job[0]} raised: {e}")
+                success = False
+            if success:
+                downloaded += 1
+                if downloaded % 10000 == 0:
+                    logger.info(f"{downloaded} files downloaded")
+            else:
+                failed.append(job)
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=worker) as executor:
+        for url, local_path in jobs:
+            if len(pending) >= queue_size:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(download_file, url, local_path, logger, session, quarantine_folder=quarantine_folder)
+            pending[future] = (url, local_path)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    logger.info(f"{downloaded} files downloaded, {len(failed)} failed")
+    for url, local_path in failed:
+        logger.error(f"Failed to download {url}")
+    return failed
@@ -1,81 +1,75 @@
 import utils
 import sys
 
+enzyme_table = "orenza_enzyme"
 
-def swiss_explorenz(database: str, table_type: str, logger):
+# count column of the enzyme table, query counting the rows of each ec number in the table of a source,
+# and whether a row makes the enzyme not orphan
+SOURCE_COUNTS = [
+    ("sprot_count", "SELECT ec_id AS ec_number, COUNT(*) AS count FROM orenza_sprot_ec_numbers GROUP BY ec_id", True),
+    ("trembl_count", "SELECT ec_id AS ec_number, COUNT(*) AS count FROM orenza_trembl_ec_numbers GROUP BY ec_id", True),
+    ("pdb_count", "SELECT ec_number_id AS ec_number, COUNT(*) AS count FROM orenza_pdb GROUP BY ec_number_id", True),
+    ("species_count", "SELECT enzyme_id AS ec_number, COUNT(*) AS count FROM orenza_species_enzymes GROUP BY enzyme_id", False),
+]
+
+
+def enzyme_counts(database: str, logger):
     """
-    Update enzyme table based on the information of the joint table of ec and sprot or trembl
+    Update the counts of the enzyme table based on the joint tables of sprot, trembl and species and on the pdb table,
+    one aggregation per table in a single transaction. An enzyme without sprot, trembl or pdb entry is orphan.
     Args:
         database : name and path of the database to Update
-        table_type: update enzyme based on trembl or sprot
     """
-    if table_type not in ["sprot", "trembl"]:
-        raise ValueError("Invalid table_type. Allowed values are 'sprot' or 'trembl'.")
-
-    joint_table = f"orenza_{table_type}_ec_numbers"
-    ec_table = "orenza_ec"
-    enzyme_table = "orenza_enzyme"
-
     con = utils.create_connection(database=database, logger=logger)
 
     if not con:
         sys.exit()
 
     cur = con.cursor()
-
-    cur.execute(f"SELECT number FROM {ec_table}")
-    ec_number = cur.fetchall()
-    for ec in ec_number:
-        # cur return tuple, so we get only the ec_number value
-        query_matching = f"SELECT ec_number FROM {enzyme_table} WHERE ec_number=?"
-        cur.execute(query_matching, ec)
-        matching = cur.fetchone()
-
-        if matching:
-            query_count = f"SELECT COUNT(*) FROM {joint_table} WHERE ec_id=?"
-            cur.execute(query_count, ec)
-            count = cur.fetchone()
-            query_update = f"UPDATE {enzyme_table} SET orphan=0, {table_type}_count=? WHERE ec_number=?"
-            data_update = (count[0], ec[0])
-            cur.execute(query_update, data_update)
-            con.commit()
+    # the counts of the previous update are reset, the ec numbers without row keep 0
+    columns = ", ".join(f"{column} = 0" for column, _, _ in SOURCE_COUNTS)
+    cur.execute(f"UPDATE {enzyme_table} SET {columns}, orphan = 1")
+    for column, query_count, linked in SOURCE_COUNTS:
+        orphan = ", orphan = 0" if linked else ""
+        query_update = f"""
+                UPDATE {enzyme_table} SET {column} = source.count{orphan}
+                FROM ({query_count}) AS source
+                WHERE source.ec_number = {enzyme_table}.ec_number
+                """
+        cur.execute(query_update)
+        logger.info(f"{column} set for {cur.rowcount} enzymes")
+    con.commit()
+    cur.execute(f"SELECT COUNT(*) FROM {enzyme_table} WHERE orphan")
+    logger.info(f"{cur.fetchone()[0]} orphan enzymes")
     con.close()
 
 
-def species(database: str, logger):
-    joint_table = "orenza_species_enzymes"
-    enzyme_table = "orenza_enzyme"
-
-    con = utils.create_connection(database=database, logger=logger)
-
-    if not con:
-        sys.exit()
-
-    cur = con.cursor()
-
-    cur.execute(f"SELECT DISTINCT enzyme_id FROM {joint_table}")
-    ec_number = cur.fetchall()
-    for ec in ec_number:
-        query_matching = f"SELECT ec_number FROM {enzyme_table} WHERE ec_number=?"
-        cur.execute(query_matching, ec)
-        matching = cur.fetchone()
-
-        if matching:
-            query_count = f"SELECT COUNT(*) FROM {joint_table} where enzyme_id=?"
-            cur.execute(query_count, ec)
-            count = cur.fetchone()
-            query_update = (
-                f"UPDATE {enzyme_table} SET species_count=? WHERE ec_number=?"
-            )
-            data_update = (count[0], ec[0])
-            cur.execute(query_update, data_update)
-            con.commit()
-    con.close()
+rollup_table = "orenza_rollup"
+
+# not part of the schema of the web server, created by the update
+ROLLUP_SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS "{rollup_table}" (
+        "ec_number" varchar(30) NOT NULL PRIMARY KEY,
+        "level" integer NOT NULL,
+        "enzyme_count" integer NOT NULL,
+        "orphan_count" integer NOT NULL,
+        "sprot_count" integer NOT NULL,
+        "trembl_count" integer NOT NULL,
+        "pdb_count" integer NOT NULL,
+        "species_count" integer NOT NULL
+    )
+    """
 
 
-def pdb(database: str, logger):
-    pdb_table = "orenza_pdb"
-    enzyme_table = "orenza_enzyme"
+def rollup(database: str, logger):
+    """
+    Build again the rollup table: for each class, subclass and sub-subclass of the nomenclature table, keyed by
+    its pseudo ec number (e.g. 1.1.2.-), the number of enzymes and orphan enzymes and the totals of their
+    sprot, trembl, pdb and species counts. To be run once the counts of the enzyme table are set (see enzyme_counts).
+    Args:
+        database : name and path of the database to Update
+    """
+    nomenclature_table = "orenza_nomenclature"
 
     con = utils.create_connection(database=database, logger=logger)
 
@@ -83,22 +77,24 @@ def pdb(database: str, logger):
         sys.exit()
 
     cur = con.cursor()
-
-    cur.execute(f"SELECT ec_number_id FROM {pdb_table}")
-    ec_number = cur.fetchall()
-    for ec in ec_number:
-        query_matching = f"SELECT ec_number FROM {enzyme_table} WHERE ec_number=?"
-        cur.execute(query_matching, ec)
-        matching = cur.fetchone()
-
-        if matching:
-            query_count = f"SELECT COUNT(*) FROM {pdb_table} where ec_number_id=?"
-            cur.execute(query_count, ec)
-            count = cur.fetchone()
-            query_update = (
-                f"UPDATE {enzyme_table} SET orphan=0, pdb_count=? WHERE ec_number=?"
-            )
-            data_update = (count[0], ec[0])
-            cur.execute(query_update, data_update)
-            con.commit()
+    cur.execute(ROLLUP_SCHEMA)
+    cur.execute(f"DELETE FROM {rollup_table}")
+    # the numbers of the levels below the one of a nomenclature entry are 0
+    query_rollup = f"""
+            INSERT INTO {rollup_table} (ec_number, level, enzyme_count, orphan_count,
+                                        sprot_count, trembl_count, pdb_count, species_count)
+            SELECT nomenclature.ec_number,
+                   CASE WHEN nomenclature.second_number = 0 THEN 1 WHEN nomenclature.third_number = 0 THEN 2 ELSE 3 END,
+                   COUNT(enzyme.ec_number), TOTAL(enzyme.orphan), TOTAL(enzyme.sprot_count), TOTAL(enzyme.trembl_count),
+                   TOTAL(enzyme.pdb_count), TOTAL(enzyme.species_count)
+            FROM {nomenclature_table} AS nomenclature
+            LEFT JOIN {enzyme_table} AS enzyme
+                ON enzyme.first_number = nomenclature.first_number
+                AND nomenclature.second_number IN (0, enzyme.second_number)
+                AND nomenclature.third_number IN (0, enzyme.third_number)
+            GROUP BY nomenclature.ec_number
+            """
+    cur.execute(query_rollup)
+    logger.info(f"{cur.rowcount} rows in {rollup_table}")
+    con.commit()
     con.close()
@@ -1,14 +1,29 @@
 #!/usr/bin/env python
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from functools import partial
 import gzip
+import io
+import logging
+import mmap
 import tarfile
 import xml.etree.ElementTree as ET
+import json
 import re
 import os
 from io import StringIO
 from html.parser import HTMLParser
-import utils
+import columnar
+
+try:
+    import indexed_gzip
+except ImportError:  # optional, only needed to parse .gz files in parallel
+    indexed_gzip = None
+
+# bump the version of a source when the content of its parsed data changes,
+# its entries of the parse cache (see cache.py) are then parsed again
+PARSER_VERSIONS = {"explorenz": "2", "uniprot": "2", "brenda": "2"}
 
 
 # from https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python
@@ -61,6 +76,23 @@ def gunzip_file(input_file: str, output_file: str, logger, block_size=65536):
         logger.exception(f"An unexpected error occurred: {str(e)}")
 
 
+def open_binary(input_file):
+    """
+    Open a file for reading, decompressing it on the fly when needed,
+    so that no uncompressed copy has to be written to disk.
+    Args:
+        input_file: path to a plain or .gz file, or a binary stream of gzip compressed data
+                    (e.g. from download.ftp_stream)
+    Returns:
+        binary file object
+    """
+    if not isinstance(input_file, str):
+        return gzip.GzipFile(fileobj=input_file, mode="rb")
+    if input_file.endswith(".gz"):
+        return gzip.open(input_file, "rb")
+    return open(input_file, "rb")
+
+
 def extract_tar(input_file: str, output_folder: str):
     with tarfile.open(input_file, "r") as f:
         try:
@@ -69,74 +101,339 @@ def extract_tar(input_file: str, output_folder: str):
             f.extractall(output_folder) # depends on python version
 
 # based on this https://web.expasy.org/docs/userman.html from 27/03/2024
+# precompiled byte patterns, records are never decoded
+UNIPROT_RECORD_END = b"\n//\n"
+pattern_uniprot_ac_line = re.compile(rb"^AC[^\n]*", re.M)
+# pattern given by the userman (see link above)
+pattern_uniprot_accession = re.compile(rb"[OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9](?:[A-Z][A-Z0-9]{2}[0-9]){1,2}")
+pattern_uniprot_de_ec_line = re.compile(rb"^DE[^\n]*EC=[^\n]*", re.M)
+pattern_uniprot_ec = re.compile(rb"(?:(?:\d+|-)\.){3}(?:\d+|-)")
+# size of the blocks read from compressed inputs
+UNIPROT_BLOCK_SIZE = 64 << 20
+# uncompressed bytes between two access points of a gzip index
+GZIP_INDEX_SPACING = 16 << 20
+
+
+def scan_uniprot(buffer, start=0, end=None):
+    """
+    Scan uniprot records held in memory (bytes or mmap) and yield the proteins containing ec numbers.
+    The scan jumps from one "EC=" to the next with find, so records without ec number are skipped
+    without being looked at, and only the records containing one are copied.
+
+    Args:
+        buffer: bytes-like object with find/rfind (bytes, mmap)
+        start: offset of the first record to scan (must be the start of a record)
+        end: offset of the end of the last record to scan
+    Yield:
+        (primary accession, [ec numbers found on the DE lines])
+    """
+    end = len(buffer) if end is None else end
+    position = start
+    while position < end:
+        ec_position = buffer.find(b"EC=", position, end)
+        if ec_position == -1:
+            return
+        record_start = buffer.rfind(UNIPROT_RECORD_END, position, ec_position)
+        record_start = position if record_start == -1 else record_start + len(UNIPROT_RECORD_END)
+        record_end = buffer.find(UNIPROT_RECORD_END, ec_position, end)
+        record_end = end if record_end == -1 else record_end + len(UNIPROT_RECORD_END)
+        position = record_end
+
+        record = buffer[record_start:record_end]
+        lines = pattern_uniprot_de_ec_line.findall(record)  # "EC=" may also be on CC lines
+        if not lines:
+            continue
+        ec_list = []
+        for line in lines:
+            match = pattern_uniprot_ec.search(line)
+            if match:
+                ec_list.append(match.group().decode())
+        ac_line = pattern_uniprot_ac_line.search(record)
+        match = pattern_uniprot_accession.search(ac_line.group()) if ac_line else None
+        if match:  # only get the primary accession number
+            yield match.group().decode(), ec_list
+
+
 def read_uniprot(input_file: str):
     """
-    Read the uniprot field and yield of proteins containing ec numbers
+    Read the uniprot field and yield of proteins containing ec numbers.
+    A plain file is memory mapped, compressed inputs are read by large blocks.
 
     Args:
-        input_file: name and path of the input file
+        input_file: name and path of the input file (.dat or .dat.gz) or gzip compressed stream
     Yield:
-        yield protein containing atleast one ec number
+        (primary accession, [ec numbers]) of the proteins containing atleast one ec number
     """
-    with open(input_file, "r") as f:
-        line = f.readline()
-        current = ""
-        contain_ec = False
-        while line:
-            current += line
-            if line.startswith("DE"):
-                if "EC=" in line:
-                    contain_ec = True
+    if isinstance(input_file, str) and not input_file.endswith(".gz"):
+        with open(input_file, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield from scan_uniprot(buffer)
+        return
 
-            if line.startswith("//"):
-                if contain_ec:
-                    yield current
-                current = ""
-                contain_ec = False
-            line = f.readline()
+    with open_binary(input_file) as f:
+        leftover = b""
+        while True:
+            block = f.read(UNIPROT_BLOCK_SIZE)
+            if not block:
+                break
+            block = leftover + block
+            cut = block.rfind(UNIPROT_RECORD_END) + len(UNIPROT_RECORD_END)
+            if cut < len(UNIPROT_RECORD_END):  # no complete record yet
+                leftover = block
+                continue
+            yield from scan_uniprot(block, 0, cut)
+            leftover = block[cut:]
+        if leftover:
+            yield from scan_uniprot(leftover)
+
+
+def uniprot_ec_numbers(ec_list: list):
+    """
+    Args:
+        ec_list: ec numbers of a protein
+    Returns:
+        list of (ec number, is complete) without duplicate
+    """
+    ec_set = set(ec_list)  # change in set to remove duplicate ec
+    list_ec_complete = []
+    for ec in ec_set:
+        is_complete = True
+        if "-" in ec or not ec[-1].isdigit():
+            is_complete = False
+        list_ec_complete.append((ec, is_complete))
+    return list_ec_complete
+
+
+def uniprot_shards(input_file: str, shards: int):
+    """
+    Split an uncompressed uniprot file in byte ranges aligned on the record boundaries
+
+    Args:
+        input_file: name and path of the input file (.dat)
+        shards: number of ranges wanted
+    Returns:
+        list of (start, end)
+    """
+    size = os.path.getsize(input_file)
+    if size == 0:
+        return []
+    boundaries = [0]
+    with open(input_file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for i in range(1, shards):
+                boundary = buffer.find(UNIPROT_RECORD_END, max(size * i // shards - 1, boundaries[-1]))
+                if boundary == -1:
+                    break
+                boundary += len(UNIPROT_RECORD_END)
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def uniprot_mmap_records(input_file: str, start: int, end: int):
+    """
+    Scan a range of an uncompressed uniprot file
+    Args:
+        input_file: name and path of the input file (.dat)
+        start, end: byte range aligned on the record boundaries (see uniprot_shards)
+    Yield:
+        (primary accession, [ec numbers])
+    """
+    with open(input_file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield from scan_uniprot(buffer, start, end)
 
 
-def uniprot(input_file: str, output_file: str, logger):
+def uniprot_rows(accession: str, ec_list: list):
+    """
+    Returns:
+        The rows (accession, ec number, is complete) of a protein (see columnar.SCHEMAS)
+    """
+    return [(accession, ec_number, complete) for ec_number, complete in uniprot_ec_numbers(ec_list)]
+
+
+def uniprot_shard(records, start: int, end: int, run_file=None, memory_budget=None):
+    """
+    Parse a shard of a uniprot file (run in a worker process)
+    Args:
+        records: function (start, end) yielding the records of the shard (uniprot_mmap_records or uniprot_gzip_records)
+        start, end: range of the shard
+        run_file: if given, the rows are written as sorted runs named after run_file (see columnar.SpillBuffer)
+        memory_budget: size in bytes of the rows held in memory before a run is written
+    Returns:
+        list of rows (accession, ec number, is complete), or the names of the runs if run_file is given
+    """
+    if run_file is None:
+        return [row for accession, ec_list in records(start, end) for row in uniprot_rows(accession, ec_list)]
+    buffer = columnar.SpillBuffer("uniprot", run_file, logging.getLogger(__name__), memory_budget)
+    for accession, ec_list in records(start, end):
+        buffer.extend(uniprot_rows(accession, ec_list))
+    return buffer.dump()
+
+
+def gzip_index(input_file: str, logger, spacing=GZIP_INDEX_SPACING):
+    """
+    Build a random access index of a gzip file (access points with their window state every spacing bytes,
+    see indexed_gzip), so that it can be decompressed from any point.
+    The index is built once and cached next to the archive as input_file.gzidx, it is built again
+    if the archive changed.
+
+    Args:
+        input_file: name and path of the .gz file
+        spacing: uncompressed bytes between two access points
+    Returns:
+        (name of the index file, uncompressed size)
+    """
+    index_file = input_file + ".gzidx"
+    info_file = index_file + ".json"
+    stat = os.stat(input_file)
+    archive = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if os.path.exists(index_file) and os.path.exists(info_file):
+        with open(info_file, "r") as f:
+            info = json.load(f)
+        if info["archive"] == archive:
+            return index_file, info["uncompressed_size"]
+
+    logger.info(f"Building the gzip index of {input_file}")
+    with indexed_gzip.IndexedGzipFile(input_file, spacing=spacing) as f:
+        f.build_full_index()
+        f.seek(0, os.SEEK_END)
+        uncompressed_size = f.tell()
+        f.export_index(index_file)
+    with open(info_file, "w") as f:
+        json.dump({"archive": archive, "uncompressed_size": uncompressed_size}, f)
+    return index_file, uncompressed_size
+
+
+def scan_uniprot_range(f, start: int, end: int):
+    """
+    Yield the proteins containing ec numbers of the records starting in [start, end) of a seekable binary file.
+    The ranges do not need to be aligned on the records: the first partial record belongs to the previous range
+    and the last one is read past end.
+
+    Args:
+        f: binary file object supporting seek (e.g. indexed_gzip.IndexedGzipFile)
+        start, end: uncompressed byte range
+    Yield:
+        (primary accession, [ec numbers])
+    """
+    position = max(start - len(UNIPROT_RECORD_END), 0)
+    f.seek(position)
+    buffer = b""
+    aligned = start == 0
+    while True:
+        block = f.read(UNIPROT_BLOCK_SIZE)
+        buffer += block
+        if not aligned:  # skip to the first record starting at or after start
+            record_end = buffer.find(UNIPROT_RECORD_END)
+            if record_end == -1:
+                if not block:
+                    return
+                kept = len(UNIPROT_RECORD_END) - 1
+                position += len(buffer) - kept
+                buffer = buffer[-kept:]
+                continue
+            record_end += len(UNIPROT_RECORD_END)
+            position += record_end
+            buffer = buffer[record_end:]
+            aligned = True
+        # buffer starts with a record starting at position
+        if position >= end:
+            return
+        stop = buffer.find(UNIPROT_RECORD_END, max(end - position - len(UNIPROT_RECORD_END), 0))
+        if stop != -1:
+            yield from scan_uniprot(buffer, 0, stop + len(UNIPROT_RECORD_END))
+            return
+        if not block:
+            yield from scan_uniprot(buffer)
+            return
+        cut = buffer.rfind(UNIPROT_RECORD_END) + len(UNIPROT_RECORD_END)
+        if cut >= len(UNIPROT_RECORD_END):
+            yield from scan_uniprot(buffer, 0, cut)
+            position += cut
+            buffer = buffer[cut:]
+
+
+def uniprot_gzip_records(input_file: str, index_file: str, start: int, end: int):
+    """
+    Scan the records starting in an uncompressed byte range of a .gz uniprot file
+    Args:
+        input_file: name and path of the input file (.dat.gz)
+        index_file: index of the input file (see gzip_index)
+        start, end: uncompressed byte range
+    Yield:
+        (primary accession, [ec numbers])
+    """
+    with indexed_gzip.IndexedGzipFile(input_file) as f:
+        f.import_index(index_file)
+        yield from scan_uniprot_range(f, start, end)
+
+
+def uniprot(input_file: str, output_file: str, logger, worker=1, memory_budget=None):
     """
     Parse the data of uniprot.dat type of file
+    Args:
+        input_file: name and path to the input file (.dat or .dat.gz) or gzip compressed stream
+        output_file: name and path of the parsed data (see columnar.py)
+        worker: number of processes, the file is split in as many shards parsed in parallel
+                (a .gz file needs indexed_gzip, see gzip_index)
+        memory_budget: size in bytes of the parsed rows held in memory (shared by the workers),
+                       sorted runs are written next to output_file beyond it. Unlimited if None
+    """
+    buffer = columnar.SpillBuffer("uniprot", output_file, logger, memory_budget)
+    compressed = not isinstance(input_file, str) or input_file.endswith(".gz")
+    if worker > 1 and compressed and isinstance(input_file, str) and indexed_gzip is None:
+        logger.warning("indexed_gzip is not installed, a .gz file can only be parsed by one process")
+    if worker > 1 and (not compressed or isinstance(input_file, str) and indexed_gzip is not None):
+        if compressed:
+            index_file, size = gzip_index(input_file, logger)
+            shards = [(size * i // worker, size * (i + 1) // worker) for i in range(worker)]
+            records = partial(uniprot_gzip_records, input_file, index_file)
+        else:
+            shards = uniprot_shards(input_file, worker)
+            records = partial(uniprot_mmap_records, input_file)
+        logger.info(f"Parsing {len(shards)} shards with {worker} processes")
+        with ProcessPoolExecutor(max_workers=worker) as executor:
+            if memory_budget:
+                futures = [
+                    executor.submit(uniprot_shard, records, start, end, f"{output_file}.{i}", memory_budget // worker)
+                    for i, (start, end) in enumerate(shards)
+                ]
+            else:
+                futures = [executor.submit(uniprot_shard, records, start, end) for start, end in shards]
+            # merged in file order, so that the result is the same as a sequential parsing
+            for future in futures:
+                if memory_budget:
+                    buffer.adopt(future.result())
+                else:
+                    buffer.extend(future.result())
+    else:
+        for accession, ec_list in read_uniprot(input_file):
+            buffer.extend(uniprot_rows(accession, ec_list))
+    buffer.close()
+
 
+def uniprot_batches(input_file, batch_size=columnar.BATCH_SIZE):
+    """
+    Parse the data of uniprot.dat type of file without keeping it, for the pipeline mode (see pipeline.py)
     Args:
-        input_file: name and path to the input file
-        output_file: name and path of the parsed data in pickle format
+        input_file: name and path to the input file (.dat or .dat.gz) or gzip compressed stream
+        batch_size: number of rows per batch
+    Yield:
+        lists of rows (accession, ec number, is complete) in the order of the file
     """
-    data = {}
-    for query in read_uniprot(input_file):
-        ec_list = []
-        lines = query.splitlines()
-        first_accession_line = True
-        for line in lines:
-            if first_accession_line:
-                if line.startswith("AC"):
-                    first_accession_line = False
-                    # pattern given by the userman (see link above)
-                    pattern = "([OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2})"
-                    match = re.search(pattern, line)  # only get the primary accession number
-                    if match:
-                        accession = match.group()
-            if line.startswith("DE"):
-                if "EC=" in line:
-                    pattern = r"((\d+|-)\.){3}(\d+|-)"
-                    match = re.search(pattern, line)
-                    if match:
-                        ec_list.append(match.group())
-        data[accession] = {}
-
-        ec_set = set(ec_list)  # change in set to remove duplicate ec
-        list_ec_complete = []
-        for ec in ec_set:
-            is_complete = True
-            if "-" in ec or not ec[-1].isdigit():
-                is_complete = False
-            list_ec_complete.append((ec, is_complete))
-
-        data[accession]["ec_numbers"] = list_ec_complete
-
-    utils.save_pickle(data=data, output_file=output_file, logger=logger)
+    batch = []
+    for accession, ec_list in read_uniprot(input_file):
+        batch.extend(uniprot_rows(accession, ec_list))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 """
@@ -194,44 +491,107 @@ Data structure of the xml that I get as of 24/04/2024
 """
 
 
-def explorenz_ec(input_file: str, output_file: str, logger):
+def explorenz_rows(input_file):
     """
-    This function parse the data of an xml file from parse_explorenz
-    and extract the entry info of the ec number
+    Stream the rows of the ExplorEnz xml dump, the elements are released
+    as soon as they are read so the whole document is never held in memory
 
     Args:
-        input_file : The path to the file to be parsed
-        output_file : Name and path of the output file
+        input_file : The path to the file to be parsed (.xml or .xml.gz) or a binary stream
+
+    Yield:
+        (table name, {field name: field text}) for every row of the table_data sections
+    """
+    with open_binary(input_file) as f:
+        database = None
+        section = None
+        table = None
+        depth = 0
+        for event, element in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 2:
+                    database = element
+                elif depth == 3:
+                    section = element
+                    table = element.get("name") if element.tag == "table_data" else None
+                continue
+            depth -= 1
+            if depth == 3 and element.tag == "row" and table is not None:
+                yield table, {field.get("name"): field.text for field in element}
+                section.clear()
+            elif depth == 2:
+                # end of a table_structure / table_data section
+                table = None
+                database.clear()
+
+
+def explorenz_class_ec(fields: dict):
+    """
+    Build the pseudo ec number (e.g. 1.1.2.-) of a row of the class table
+
+    Args:
+        fields : The fields of the row
+
+    Returns:
+        The pseudo ec number
+    """
+    ec = fields["class"] + "."
+    if fields["subclass"] == "0":
+        ec = ec + "-.-.-"
+    else:
+        ec = ec + fields["subclass"] + "."
+        if fields["subsubclass"] == "0":
+            ec = ec + "-.-"
+        else:
+            ec = ec + fields["subsubclass"] + ".-"
+    return ec
+
+
+def explorenz(input_file: str, ec_output_file: str, nomenclature_output_file: str, logger):
+    """
+    This function parse the xml file from explorenz in a single pass and extract
+    the entry info of the ec numbers (entry and hist tables) and the class
+    information to build the nomenclature (class table)
+
+    Args:
+        input_file : The path to the file to be parsed (.xml or .xml.gz) or a binary stream
+        ec_output_file : Name and path of the output file for the ec numbers
+        nomenclature_output_file : Name and path of the output file for the nomenclature
     """
-    tree = ET.parse(input_file)
-    root = tree.getroot()
     data = {}  # will contain the ecc and a subdictionary with his parameter
-    for table_data in root.findall("database/table_data[@name='entry']"):
-        for row in table_data.findall("row"):
-            ec_num = row.find("field[@name='ec_num']")  # get the current_ec of the row
+    nomenclature = {}
+    created = {}  # the hist table may come before or after the entry table
+    removed = set()
+    pattern_created = re.compile("created ([0-9]*)")
+    for table, fields in explorenz_rows(input_file):
+        if table == "entry":
+            ec_num = fields.pop("ec_num", None)
             if ec_num is not None:
-                data[ec_num.text] = {}
-                for field in row.findall("field"):
-                    if field.attrib["name"] != "ec_num":
-                        data[ec_num.text][field.attrib["name"]] = field.text
-
-    for table_data in root.findall("database/table_data[@name='hist']"):
-        for row in table_data.findall("row"):
-            ec_num = row.find("field[@name='ec_num']")  # get the current_ec of the row
-            date_created = row.find("field[@name='history']")
-
-            pattern = "created ([0-9]*)"
-            match = re.search(pattern=pattern, string=date_created.text)
+                data[ec_num] = fields
+        elif table == "hist":
+            ec_num = fields["ec_num"]
+            match = pattern_created.search(fields["history"] or "")
             if match:
-                created = match.group(1)
-            if data[ec_num.text]:
-                data[ec_num.text]["created"] = created
-            ec_action = row.find("field[@name='action']")
-            if (
-                ec_action.text == "deleted" or ec_action.text == "transferred"
-            ):  # check history to the deleted action because the entry is still present even if deleted
-                data.pop(ec_num.text)
-    utils.save_pickle(data, output_file, logger)
+                created[ec_num] = match.group(1)
+            if fields["action"] in ("deleted", "transferred"):
+                # the entry is still present even if deleted
+                removed.add(ec_num)
+        elif table == "class":
+            nomenclature[explorenz_class_ec(fields)] = {
+                "first_number": fields["class"],
+                "second_number": fields["subclass"],
+                "third_number": fields["subsubclass"],
+                "heading": strip_tags(fields["heading"]),
+            }
+
+    for ec_num, year in created.items():
+        if data.get(ec_num):
+            data[ec_num]["created"] = year
+    for ec_num in removed:
+        data.pop(ec_num, None)
+    columnar.save("explorenz_ec", data, ec_output_file, logger)
+    columnar.save("explorenz_nomenclature", nomenclature, nomenclature_output_file, logger)
 
 
 """
@@ -250,131 +610,345 @@ def explorenz_ec(input_file: str, output_file: str, logger):
 """
 
 
-def explorenz_nomenclature(input_file: str, output_file: str, logger):
+# based on the description at the top of the brenda flat file
+pattern_brenda_id = re.compile(r"ID\t([0-9.]+)")
+pattern_brenda_species = re.compile(r"PR\t#[0-9]+# (\w* \w*)")
+# "#1,2# 0.03 {NAD+}  (#1# pH 7.0 <4>) <4,12>", the value may be a range (0.1-0.5) or -999 (no value)
+pattern_brenda_value = re.compile(r"\t#[0-9,\s]+#\s*(\S+)(?:\s*\{(.*?)\})?")
+# "#1,2# NAD(P)H  (#1# 10 mM <4>) <4,12>", the name stops at the comments or the references
+pattern_brenda_cofactor = re.compile(r"\t#[0-9,\s]+#\s*(.+?)\s*(?:\(#|<[0-9]|$)")
+# section code of the lines kept besides PR, and key of the values in the output
+BRENDA_KINETICS = {"KM": "km_value", "TN": "turnover_number", "SA": "specific_activity"}
+
+
+@contextmanager
+def open_brenda(input_file: str):
     """
-    This function parse the data of an xml file from parse_explorenz
-    and extract the class information to build the nomenclature
+    Open the brenda flat file as a text stream, when given the .txt.tar.gz downloaded
+    from brenda the text member is read straight from the archive without extracting it
 
     Args:
-        input_file : The path to the file to be parsed
-        output_file : Name and path of the output file
+        input_file : The path to the brenda file (.txt or .txt.tar.gz)
+
+    Yield:
+        A text stream of the flat file
     """
-    tree = ET.parse(input_file)
-    root = tree.getroot()
-    data = {}  # will contain the ecc and a subdictionary with his parameter
-    for table_data in root.findall("database/table_data[@name='class']"):
-        for row in table_data.findall("row"):
-            first = row.find("field[@name='class']")
-            second = row.find("field[@name='subclass']")
-            third = row.find("field[@name='subsubclass']")
-            heading = row.find("field[@name='heading']")
-            heading = strip_tags(heading.text)
-            ec = first.text + "."
-            if second.text == "0":
-                ec = ec + "-.-.-"
-            else:
-                ec = ec + second.text + "."
-                if third.text == "0":
-                    ec = ec + "-.-"
-                else:
-                    ec = ec + third.text + ".-"
-            data[ec] = {
-                "first_number": first.text,
-                "second_number": second.text,
-                "third_number": third.text,
-                "heading": heading,
-            }
-    utils.save_pickle(data, output_file, logger)
+    if not input_file.endswith((".tar.gz", ".tgz", ".tar")):
+        with open(input_file, "r") as f:
+            yield f
+        return
+    with tarfile.open(input_file, "r:*") as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith(".txt"):
+                with io.TextIOWrapper(archive.extractfile(member), encoding="utf-8", errors="replace") as f:
+                    yield f
+                return
+    raise FileNotFoundError(f"No .txt file in {input_file}")
 
 
-def brenda(input_file: str, output_file: str, logger):
+def brenda_lines(f):
     """
-    This function parse the .txt from brenda and extract the ec number
-    and the associated species.
+    Join the continuation lines (starting with a tab) of the brenda flat file
 
     Args:
-        input_file : The path to the file to be parsed
-        output_file : Name and path of the output file
+        f : A text stream of the flat file
+
+    Yield:
+        Every logical line of the file without its line break
     """
-    with open(input_file, "r") as f:
-        lines = f.readlines()
-        data = {}
-        new_query = True
-        ec_number = ""
-        species = []
-        for line in lines:
-            if line.startswith("ID"):
-                pattern = "ID\t([0-9.]+)"
-                match = re.search(pattern, line)
+    current = None
+    for line in f:
+        line = line.rstrip("\n")
+        if line.startswith("\t") and current is not None:
+            current = current + " " + line.strip()
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def brenda_entries(input_file: str):
+    """
+    Stream the entries of the brenda flat file, one ec number at a time
+
+    Args:
+        input_file : The path to the brenda file (.txt or .txt.tar.gz)
+
+    Yield:
+        (ec number, {"species": [...], "km_value": [(value, substrate)...], "turnover_number": [(value, substrate)...],
+         "specific_activity": [(value, None)...], "cofactors": [...]})
+    """
+    with open_brenda(input_file) as f:
+        ec_number = None
+        for line in brenda_lines(f):
+            code = line[:2]
+            if code == "ID":
+                match = pattern_brenda_id.match(line)
                 if match:
                     ec_number = match.group(1)
-                    new_query = False
-                    data[ec_number] = {}
-            if line.startswith("PR") and not new_query:
-                pattern = r"PR\t#[0-9]+# (\w* \w*)"
-                match = re.search(pattern, line)
+                    species = []
+                    seen = set()
+                    entry = {"species": species, "cofactors": []}
+                    for key in BRENDA_KINETICS.values():
+                        entry[key] = []
+                    kinetics_seen = set()
+                    cofactors_seen = set()
+            elif ec_number is None:
+                continue
+            elif code == "PR":
+                match = pattern_brenda_species.match(line)
                 if match:
-                    stripped_match = match.group(1).strip()
-                    if stripped_match not in species and stripped_match != "no activity":
-                        species.append(stripped_match)
-
-            if line.startswith(r"///") and not new_query:
-                data[ec_number]["species"] = species.copy()
-                ec_number = ""
-                species.clear()
-                new_query = True
-        utils.save_pickle(data, output_file, logger)
-
-
-def multiprocessing_pdb_iterate(root_dir: str, output_file: str, logger):
-    data = {}
-    with ProcessPoolExecutor() as executor:
-        futures = []
-        for root, dirs, files in os.walk(root_dir):
-            for file in files:
-                full_path = os.path.join(root, file)
-                futures.append(executor.submit(pdb, full_path))
-
-        for future in as_completed(futures):
-            result = future.result()
-            for ec_number, values in result.items():
-                if ec_number in data:
-                    data[ec_number].extend(values)
-                else:
-                    data[ec_number] = values
+                    name = match.group(1).strip()
+                    if name not in seen and name != "no activity":
+                        seen.add(name)
+                        species.append(name)
+            elif code in BRENDA_KINETICS:
+                match = pattern_brenda_value.match(line, 2)
+                if match and match.group(1) != "-999":
+                    value = (BRENDA_KINETICS[code], match.group(1), match.group(2))
+                    if value not in kinetics_seen:
+                        kinetics_seen.add(value)
+                        entry[value[0]].append(value[1:])
+            elif code == "CF":
+                match = pattern_brenda_cofactor.match(line, 2)
+                if match:
+                    name = match.group(1)
+                    if name not in cofactors_seen and not name.startswith("more"):
+                        cofactors_seen.add(name)
+                        entry["cofactors"].append(name)
+            elif line.startswith("///"):
+                yield ec_number, entry
+                ec_number = None
+
+
+def brenda(input_file: str, output_file: str, logger, memory_budget=None):
+    """
+    This function parse the flat file from brenda and extract the ec number
+    with the associated species, kinetic values and cofactors.
+
+    Args:
+        input_file : The path to the file to be parsed (.txt or .txt.tar.gz)
+        output_file : Name and path of the output file
+        memory_budget : size in bytes of the parsed rows held in memory, unlimited if None
+    """
+    buffer = columnar.SpillBuffer("brenda", output_file, logger, memory_budget)
+    for ec_number, entry in brenda_entries(input_file):
+        buffer.extend(columnar.entry_rows("brenda", ec_number, entry))
+    buffer.close()
+
+
+# compressed size of the pdb files parsed by a single task
+PDB_BATCH_BYTES = 32 << 20
 
-    utils.save_pickle(data, output_file, logger)
+
+def pdb_batches(files, batch_bytes=PDB_BATCH_BYTES):
+    """
+    Group the pdb files into batches of about the same compressed size
+
+    Args:
+        files: iterable of the paths of the files
+        batch_bytes: compressed size of a batch
+
+    Yield:
+        lists of paths
+    """
+    batch = []
+    size = 0
+    for file in files:
+        batch.append(file)
+        try:
+            size += os.path.getsize(file)
+        except OSError:
+            pass  # reported by pdb_batch
+        if size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def pdb_batch(files: list):
+    """
+    Parse a batch of pdb files in a worker, the results are merged by the parent (see multiprocessing_pdb_files)
+
+    Args:
+        files: list of the paths of the files
+    Returns:
+        (results, failed): the non empty results {path: result of pdb()} and the [(path, error)]
+        of the files that could not be parsed
+    """
+    results = {}
+    failed = []
+    for file in files:
+        try:
+            result = pdb(file)
+        except Exception as e:
+            failed.append((file, str(e)))
+            continue
+        if result:
+            results[file] = result
+    return results, failed
+
+
+def multiprocessing_pdb_files(files, buffer, logger, worker=None, batch_bytes=PDB_BATCH_BYTES, report_every=100):
+    """
+    Parse pdb files in parallel, by batches of files so that each task returns the results of its files at once.
+    The batches are submitted lazily: at most 2 * worker batches are pending at any time, and their rows
+    are added to the buffer as they come, so that the parsed data is not held in memory beyond its budget.
+
+    Args:
+        files: iterable of the paths of the files to parse
+        buffer: columnar.SpillBuffer of the pdb rows
+        worker: number of processes, the number of cpus if None
+        batch_bytes: compressed size of a batch
+        report_every: number of batches between two progress messages
+    Returns:
+        (pdb_ids, failed): the pdb ids {path: [pdb id]} of the parsed files with ec numbers, and the set
+        of the files that could not be parsed
+    """
+    pdb_ids = {}
+    failed = set()
+    parsed = 0
+
+    def collect(done):
+        nonlocal parsed
+        for future in done:
+            batch = pending.pop(future)
+            try:
+                batch_results, batch_failed = future.result()
+            except Exception as e:
+                logger.error(f"Could not parse a batch of {len(batch)} files: {e}")
+                failed.update(batch)
+                continue
+            for file, result in batch_results.items():
+                pdb_ids[file] = sorted({value[0] for values in result.values() for value in values})
+                for ec_number, values in result.items():
+                    buffer.extend(columnar.entry_rows("pdb", ec_number, values))
+            for file, error in batch_failed:
+                logger.error(f"Could not parse {file}: {error}")
+                failed.add(file)
+            parsed += 1
+            if parsed % report_every == 0:
+                logger.info(f"{parsed} batches parsed")
+
+    worker = worker or os.cpu_count()
+    pending = {}
+    with ProcessPoolExecutor(max_workers=worker) as executor:
+        queue_size = 2 * worker
+        for batch in pdb_batches(files, batch_bytes):
+            if len(pending) >= queue_size:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(pdb_batch, batch)] = batch
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    logger.info(f"{parsed} batches parsed, {len(pdb_ids)} files with ec numbers, {len(failed)} failed")
+    return pdb_ids, failed
 
 
 # Precompiling to improve efficiency over multiple files
-pattern_pdb_id = re.compile(r"^<PDBx:datablock\s+datablockName=\"(\w+)\"")
-pattern_ec_number = re.compile(r"<PDBx:pdbx_ec>(\d+\.\d+\.\d+\.\d+)")
-pattern_sp_id = re.compile(r"<PDBx:pdbx_db_accession>(\w+)<\/PDBx:pdbx_db_accession>")
+pattern_pdb_id = re.compile(rb"<PDBx:datablock\s+datablockName=\"(\w+)\"")
+pattern_pdb_category = re.compile(rb"<PDBx:(entity|struct_ref)Category[\s>]")
+pattern_pdb_entity = re.compile(rb"<PDBx:entity\s+id=\"([^\"]*)\"\s*>(.*?)</PDBx:entity>", re.S)
+pattern_pdb_struct_ref = re.compile(rb"<PDBx:struct_ref\s+id=\"[^\"]*\"\s*>(.*?)</PDBx:struct_ref>", re.S)
+pattern_ec_number = re.compile(rb"<PDBx:pdbx_ec>([^<]*)</PDBx:pdbx_ec>")
+pattern_ec_complete = re.compile(rb"\d+\.\d+\.\d+\.\d+")
+pattern_sp_db = re.compile(rb"<PDBx:db_name>([^<]*)</PDBx:db_name>")
+pattern_sp_entity = re.compile(rb"<PDBx:entity_id>([^<]*)</PDBx:entity_id>")
+pattern_sp_id = re.compile(rb"<PDBx:pdbx_db_accession>(\w+)</PDBx:pdbx_db_accession>")
+# size of the blocks decompressed from a pdb file
+PDB_BLOCK_SIZE = 1 << 20
+# bump when the content of the results of pdb() changes, the manifest entries of an older version are parsed again
+PDB_PARSER_VERSION = 2
+
+
+def pdb_categories(f, block_size=PDB_BLOCK_SIZE):
+    """
+    Read a PDBML file block by block and extract the entity and struct_ref categories.
+    The blocks in between are only searched for the opening tags, and the reading stops
+    as soon as both categories have been seen, so the rest of the file is never decompressed.
 
+    Args:
+        f: binary stream of the decompressed file
+        block_size: number of bytes read at once
 
-def pdb(input_file: str):
-    result = {}
-    with gzip.open(input_file, "rb") as f:
-        lines = f.readlines()
-        ec_number = ""
-        uniprot_id = ""
-        pdb_id = ""
-        ec_found = False
-        for line in lines:
-            line_decoded = line.decode()
-            match = pattern_pdb_id.search(line_decoded)
+    Returns:
+        (pdb id, {category name: bytes of the category})
+    """
+    pdb_id = ""
+    categories = {}
+    buffer = b""
+    current = None
+    first = True
+    while len(categories) < 2:
+        block = f.read(block_size)
+        if not block:
+            break
+        if first:
+            match = pattern_pdb_id.search(block)
             if match:
-                pdb_id = match.group(1)
+                pdb_id = match.group(1).decode()
+            first = False
+        searched = len(buffer)
+        buffer += block
+        while True:
+            if current is None:
+                match = pattern_pdb_category.search(buffer)
+                if not match:
+                    # keep the end of the buffer in case a tag is cut between two blocks
+                    buffer = buffer[-64:]
+                    break
+                current = match.group(1)
+                buffer = buffer[match.start():]
+                searched = 0
+            end_tag = b"</PDBx:" + current + b"Category>"
+            end = buffer.find(end_tag, max(searched - len(end_tag), 0))
+            if end < 0:
+                break
+            categories[current.decode()] = buffer[:end]
+            buffer = buffer[end + len(end_tag):]
+            current = None
+            if len(categories) == 2:
+                break
+    return pdb_id, categories
 
-            match = pattern_ec_number.search(line_decoded)
-            if match and not ec_found:
-                ec_number = match.group(1)
-                ec_found = True
 
-            match = pattern_sp_id.search(line_decoded)
-            if match:
-                uniprot_id = match.group(1)
+def pdb(input_file: str):
+    """
+    Extract the ec numbers of the entities of a PDBML file (.xml.gz) with the
+    uniprot accessions referenced by the same entity
 
-        if ec_number:
-            result[ec_number] = [(pdb_id, uniprot_id)]
+    Args:
+        input_file: path of the file
+
+    Returns:
+        dictionary {ec number: [(pdb id, uniprot accession, entity id)]},
+        the uniprot accession is empty when the entity does not reference uniprot
+    """
+    with gzip.open(input_file, "rb") as f:
+        pdb_id, categories = pdb_categories(f)
+
+    accessions = {}  # entity id: uniprot accessions
+    for match in pattern_pdb_struct_ref.finditer(categories.get("struct_ref", b"")):
+        struct_ref = match.group(1)
+        db_name = pattern_sp_db.search(struct_ref)
+        entity_id = pattern_sp_entity.search(struct_ref)
+        accession = pattern_sp_id.search(struct_ref)
+        if db_name and entity_id and accession and db_name.group(1) == b"UNP":
+            accessions.setdefault(entity_id.group(1).decode(), []).append(accession.group(1).decode())
+
+    result = {}
+    for match in pattern_pdb_entity.finditer(categories.get("entity", b"")):
+        entity_id = match.group(1).decode()
+        for ec_field in pattern_ec_number.finditer(match.group(2)):
+            for ec_number in pattern_ec_complete.findall(ec_field.group(1)):
+                values = result.setdefault(ec_number.decode(), [])
+                for accession in accessions.get(entity_id, [""]):
+                    if (pdb_id, accession, entity_id) not in values:
+                        values.append((pdb_id, accession, entity_id))
     return result
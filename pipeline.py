@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import multiprocessing
+import queue
+
+# In the pipeline mode, the batches of rows of a parser are written to the database by another process
+# while the parsing goes on, the parsed data is neither held in memory nor written to a file in between.
+
+# end of the batches on the queue
+END = None
+
+
+def queue_batches(batch_queue):
+    """
+    Yield:
+        the batches put on the queue until the end marker
+    """
+    while True:
+        batch = batch_queue.get()
+        if batch is END:
+            return
+        yield batch
+
+
+def consume(batch_queue, result_queue, writer, args: tuple):
+    """
+    Run writer on the batches of the queue and put its result, or its exception, on result_queue (run in the writer process)
+    """
+    try:
+        result_queue.put((True, writer(*args, batches=queue_batches(batch_queue))))
+    except Exception as e:
+        result_queue.put((False, e))
+
+
+def stream(batches, writer, args: tuple, logger, queue_size=8):
+    """
+    Feed the batches of a parser to a writer running in another process, through a bounded queue:
+    the parser waits when queue_size batches are pending.
+
+    Args:
+        batches: iterable of lists of rows (for instance parse.uniprot_batches)
+        writer: function called as writer(*args, batches=...) in the writer process (for instance populate.build_shard)
+        args: positional arguments of writer
+        queue_size: maximum number of batches pending
+    Returns:
+        The value returned by writer
+    """
+    context = multiprocessing.get_context()
+    batch_queue = context.Queue(queue_size)
+    result_queue = context.Queue(1)
+    process = context.Process(target=consume, args=(batch_queue, result_queue, writer, args))
+    process.start()
+
+    def put(batch):
+        while True:
+            try:
+                batch_queue.put(batch, timeout=1)
+                return
+            except queue.Full:
+                # the writer stopped, its exception is on result_queue
+                if not process.is_alive():
+                    return
+
+    count = 0
+    try:
+        for batch in batches:
+            put(batch)
+            count += 1
+            if not process.is_alive():
+                break
+        put(END)
+        while True:
+            alive = process.is_alive()
+            try:
+                done, result = result_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                # checked before the wait, so that a result put just before the end of the process is not missed
+                if not alive:
+                    raise RuntimeError(f"The writer process stopped with exit code {process.exitcode}")
+    except BaseException:
+        process.terminate()
+        raise
+    finally:
+        process.join()
+    if not done:
+        raise result
+    logger.info(f"{count} batches written by the pipeline")
+    return result
@@ -1,17 +1,206 @@
 #!/usr/bin/env python
-import sys
+from collections import Counter
+from itertools import groupby
+from urllib.parse import quote
+import os
+import shutil
+import sqlite3
+import columnar
 import utils
 
+# All the functions take a connection opened by the caller (see update.populate_db), the rows
+# are streamed from the Arrow files to executemany and each table is filled in a single transaction.
+# The keys checked while inserting are loaded once in sets and kept up to date, no query is sent per row.
+# Each function returns its part of the populate report (see update.populate_db).
+# The secondary indexes of a table are dropped while it is filled and built again from the loaded rows,
+# unless only the differences with the existing rows are applied (delta, see fill_table).
+
+# columns filled by populate, key columns and values of the other columns for the new rows of each table
+TABLE_COLUMNS = {
+    "orenza_enzyme": (
+        ["ec_number", "reaction", "comments", "created", "first_number", "second_number", "third_number",
+         "common_name", "systematic_name", "other_name"],
+        ["ec_number"],
+        {"orphan": "1", "sprot_count": "0", "trembl_count": "0", "pdb_count": "0", "species_count": "0"},
+    ),
+    "orenza_nomenclature": (["ec_number", "heading", "first_number", "second_number", "third_number"], ["ec_number"], {}),
+    "orenza_sprot": (["accession"], ["accession"], {}),
+    "orenza_sprot_ec_numbers": (["sprot_id", "ec_id"], ["sprot_id", "ec_id"], {}),
+    "orenza_trembl": (["accession"], ["accession"], {}),
+    "orenza_trembl_ec_numbers": (["trembl_id", "ec_id"], ["trembl_id", "ec_id"], {}),
+    "orenza_kegg": (["pathway", "pathway_class"], ["pathway"], {}),
+    "orenza_kegg_enzymes": (["kegg_id", "enzyme_id"], ["kegg_id", "enzyme_id"], {}),
+    "orenza_species": (["name"], ["name"], {}),
+    "orenza_species_enzymes": (["species_id", "enzyme_id"], ["species_id", "enzyme_id"], {}),
+    "orenza_pdb": (["accession", "uniprot_accession", "ec_number_id"], ["accession"], {}),
+}
+
+# tables filled by each source loaded after explorenz, the ones of a source can be built in a shard (see build_shard)
+SOURCE_TABLES = {
+    "sprot": ["orenza_sprot", "orenza_sprot_ec_numbers"],
+    "trembl": ["orenza_trembl", "orenza_trembl_ec_numbers"],
+    "kegg": ["orenza_kegg", "orenza_kegg_enzymes"],
+    "brenda": ["orenza_species", "orenza_species_enzymes"],
+    "pdb": ["orenza_pdb"],
+}
+
+
+def load_keys(con, table: str, column: str):
+    """
+    Args:
+        con: connection to the database
+        table: name of the table
+        column: name of the key column
+    Returns:
+        The set of the values of the column
+    """
+    return {key for (key,) in con.execute(f"SELECT {column} FROM {table}")}
+
+
+def drop_indexes(con, tables: list, logger):
+    """
+    Drop the indexes of some tables, except those of their primary key
+
+    Args:
+        con: connection to the database
+        tables: names of the tables
+    Returns:
+        The dropped indexes (name, table, sql, unique, columns), to be given to create_indexes
+    """
+    indexes = []
+    for table in tables:
+        query = "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL"
+        for name, sql in con.execute(query, (table,)).fetchall():
+            unique = any(row[1] == name and row[2] for row in con.execute(f'PRAGMA index_list("{table}")'))
+            columns = [row[2] for row in con.execute(f'PRAGMA index_info("{name}")')]
+            indexes.append((name, table, sql, unique, columns))
+            con.execute(f'DROP INDEX "{name}"')
+    con.commit()
+    if indexes:
+        logger.info(f"{len(indexes)} indexes dropped during the load of {', '.join(tables)}")
+    return indexes
+
+
+def create_indexes(con, indexes: list, logger):
+    """
+    Build again the indexes dropped by drop_indexes, in a single transaction. If the rows break
+    a unique index, only the first row of each key is kept.
+
+    Args:
+        con: connection to the database
+        indexes: the dropped indexes
+    Returns:
+        The number of duplicate rows removed
+    """
+    removed = 0
+    for name, table, sql, unique, columns in indexes:
+        try:
+            con.execute(sql)
+        except sqlite3.IntegrityError:
+            if not unique:
+                raise
+            keys = ", ".join(f'"{column}"' for column in columns)
+            cur = con.execute(f'DELETE FROM "{table}" WHERE rowid NOT IN (SELECT MIN(rowid) FROM "{table}" GROUP BY {keys})')
+            logger.warning(f"{cur.rowcount} duplicate rows of {table} removed, they break the unique index {name}")
+            removed += cur.rowcount
+            con.execute(sql)
+    con.commit()
+    return removed
+
+
+def fill_table(con, table: str, rows, logger, delta=False):
+    """
+    Replace the content of a table by some rows, in a single transaction. With delta, the rows
+    are staged in a temporary table and only the differences are applied (see sync_table).
+
+    Args:
+        con: connection to the database
+        table: name of the table (see TABLE_COLUMNS)
+        rows: iterable of tuples in the order of the columns of the table in TABLE_COLUMNS
+        delta: only apply the differences between the table and the rows
+    Returns:
+        The number of rows inserted, updated and deleted
+    """
+    columns, keys, defaults = TABLE_COLUMNS[table]
+    names = ", ".join(columns)
+    if not delta:
+        deleted = con.execute(f"DELETE FROM {table}").rowcount
+        values = ", ".join(["?"] * len(columns) + list(defaults.values()))
+        cur = con.executemany(f"INSERT INTO {table} ({', '.join(columns + list(defaults))}) VALUES ({values})", rows)
+        con.commit()
+        return {"inserted": max(cur.rowcount, 0), "updated": 0, "deleted": deleted}
+
+    stage = f"stage_{table}"
+    con.execute(f"DROP TABLE IF EXISTS temp.{stage}")
+    con.execute(f"CREATE TEMP TABLE {stage} AS SELECT {names} FROM main.{table} WHERE 0")
+    con.executemany(f"INSERT INTO temp.{stage} VALUES ({', '.join('?' * len(columns))})", rows)
+    con.execute(f"CREATE INDEX temp.{stage}_keys ON {stage} ({', '.join(keys)})")
+    counts = sync_table(con, table, f"temp.{stage}", logger)
+    con.execute(f"DROP TABLE temp.{stage}")
+    con.commit()
+    return counts
+
+
+def sync_table(con, table: str, staged: str, logger):
+    """
+    Apply to a table the differences with its new content, compared by key: the rows whose key
+    is missing from the new content are deleted, the changed ones updated and the new ones inserted.
+
+    Args:
+        con: connection to the database
+        table: name of the table (see TABLE_COLUMNS)
+        staged: qualified name of a table holding the new content, with the columns of TABLE_COLUMNS
+            and an index on the keys
+    Returns:
+        The number of rows inserted, updated and deleted
+    """
+    columns, keys, defaults = TABLE_COLUMNS[table]
+    values = [column for column in columns if column not in keys]
+    match = " AND ".join(f"new.{key} = {table}.{key}" for key in keys)
+    deleted = con.execute(f"DELETE FROM main.{table} WHERE NOT EXISTS (SELECT 1 FROM {staged} AS new WHERE {match})").rowcount
+    updated = 0
+    if values:
+        changes = ", ".join(f"{column} = new.{column}" for column in values)
+        changed = " OR ".join(f"new.{column} IS NOT {table}.{column}" for column in values)
+        updated = con.execute(f"UPDATE main.{table} SET {changes} FROM {staged} AS new WHERE {match} AND ({changed})").rowcount
+    # with a key given twice in the new content, the first row is kept as when the unique indexes are built again
+    names = ", ".join(columns + list(defaults))
+    selected = ", ".join([f"new.{column}" for column in columns] + list(defaults.values()))
+    inserted = con.execute(
+        f"""INSERT OR IGNORE INTO main.{table} ({names}) SELECT {selected} FROM {staged} AS new
+            WHERE NOT EXISTS (SELECT 1 FROM main.{table} WHERE {match})"""
+    ).rowcount
+    if inserted or updated or deleted:
+        logger.info(f"{table}: {inserted} rows inserted, {updated} updated, {deleted} deleted")
+    return {"inserted": inserted, "updated": updated, "deleted": deleted}
+
+
+def invalid_report(count: int, invalid_ec: Counter, logger):
+    """
+    Args:
+        count: number of rows read from the parsed data
+        invalid_ec: number of rows of each ec number that is not in the enzyme table
+    Returns:
+        The report of a source
+    """
+    if invalid_ec:
+        logger.info(f"{len(invalid_ec)} ec numbers are not in the enzyme table (ec not updated to the current "
+                    f"explorenz notation), {sum(invalid_ec.values())} rows skipped")
+    return {"rows": count, "invalid_ec": dict(sorted(invalid_ec.items()))}
 
-def uniprot(filename, database, table_type, logger):
+
+def uniprot(filename, con, table_type, logger, delta=False):
     """
     Initialize the table trembl or sprot with the info of the parsing
     and the joint table between ec and this one
 
     Args:
-        filename: the name and path of the data to be added to the database (pickle format)
-        database: the name and path of the database to be updated
+        filename: the name and path of the data to be added to the database (Arrow file, see columnar.py)
+        con: connection to the database to be updated
         table_type: need to precise the table to be updated trembl or sprot
+        delta: only apply the differences with the tables (see fill_table)
+    Returns:
+        The report of the source
     """
     if table_type not in ["sprot", "trembl"]:
         raise ValueError("Invalid table_type. Allowed values are 'sprot' or 'trembl'.")
@@ -20,339 +209,428 @@ def uniprot(filename, database, table_type, logger):
     uniprot_table = f"orenza_{table_type}"
     joint_table = f"orenza_{table_type}_ec_numbers"
     ec_table = "orenza_ec"
-    con = utils.create_connection(database, logger)
-    if not con:
-        sys.exit()
 
-    cur = con.cursor()
+    logger.info("Start creating table")
+    indexes = [] if delta else drop_indexes(con, [joint_table], logger)
+    tables = {}
+    # rows sorted by accession, data structure : (accession, ec_number, ec_complete)
+    accessions = columnar.read_rows(filename, logger, columns=["accession"])
+    tables[uniprot_table] = fill_table(con, uniprot_table, (key for key, _ in groupby(accessions)), logger, delta)
+
+    count = 0
+    ec_numbers = load_keys(con, ec_table, "number")
+    new_ec = []
+
+    def joint_rows():
+        nonlocal count
+        for accession, ec_number, complete in columnar.read_rows(filename, logger):
+            count += 1
+            # the first row of an ec number gives its completeness
+            if ec_number not in ec_numbers:
+                ec_numbers.add(ec_number)
+                new_ec.append((ec_number, complete))
+            yield accession, ec_number
+
+    tables[joint_table] = fill_table(con, joint_table, joint_rows(), logger, delta)
+
+    # shared by sprot and trembl, the ec numbers are only added
+    con.executemany(f"INSERT INTO {ec_table} (number, complete) VALUES(?, ?)", sorted(new_ec))
+    con.commit()
+    duplicates = create_indexes(con, indexes, logger)
+    if not count:
+        logger.error("Table could not be read or is empty")
+    logger.info("Finished updating table")
+    return {"rows": count, "new_ec": len(new_ec), "duplicates": duplicates, "tables": tables}
 
-    if cur.execute(f"SELECT EXISTS (SELECT 1 FROM {uniprot_table})"):
-        cur.execute(f"DELETE FROM {uniprot_table}")
-        cur.execute(f"DELETE FROM {joint_table}")
-        con.commit()
 
-    logger.info("Start loading data")
-    uniprot_data = utils.load_pickle(filename, logger)
+def uniprot_stream(batches, con, table_type, logger):
+    """
+    Fill the empty tables of trembl or sprot in a single pass over batches of rows, for the
+    pipeline mode where the rows come from the parser as it goes (see pipeline.py)
+
+    Args:
+        batches: iterable of lists of rows (accession, ec_number, ec_complete), the rows of a protein
+                 follow each other
+        con: connection to the database to be updated (a shard, see build_shard)
+        table_type: need to precise the table to be updated trembl or sprot
+    Returns:
+        The report of the source
+    """
+    if table_type not in ["sprot", "trembl"]:
+        raise ValueError("Invalid table_type. Allowed values are 'sprot' or 'trembl'.")
 
     logger.info("Start creating table")
-    if uniprot_data:
-        for key in uniprot_data:
-            accession = key
-
-            query_uniprot = f"INSERT INTO {uniprot_table} (accession) VALUES (?)"
-            cur.execute(query_uniprot, (accession,))
-            tuple_list_ec = uniprot_data[key][
-                "ec_numbers"
-            ]  # data structure : [(ec_number1, ec_complete), (ec_number2, ec_complete)...]
-            for tup in tuple_list_ec:
-                query_joint_table = f"INSERT INTO {joint_table} (id, {table_type}_id, ec_id) VALUES(Null, ?, ?)"
-                cur.execute(query_joint_table, (accession, tup[0]))
-                query_pk_exist = f"SELECT EXISTS (SELECT 1 FROM {ec_table} WHERE number =?)"
-                cur.execute(query_pk_exist, (tup[0],))
-                exists = cur.fetchone()[0]
-                if not exists:
-                    query_ec = f"INSERT INTO {ec_table} (number, complete) VALUES(?, ?)"
-                    cur.execute(query_ec, tup)
-            con.commit()
+    uniprot_table = f"orenza_{table_type}"
+    joint_table = f"orenza_{table_type}_ec_numbers"
+    ec_table = "orenza_ec"
+    indexes = drop_indexes(con, [joint_table], logger)
+    count = 0
+    ec_numbers = load_keys(con, ec_table, "number")
+    new_ec = []
+    previous = None
+    query_uniprot = f"INSERT OR IGNORE INTO {uniprot_table} (accession) VALUES (?)"
+    query_joint_table = f"INSERT INTO {joint_table} ({table_type}_id, ec_id) VALUES (?, ?)"
+    for batch in batches:
+        accessions = []
+        for accession, ec_number, complete in batch:
+            if accession != previous:
+                accessions.append((accession,))
+                previous = accession
+            # the first row of an ec number gives its completeness
+            if ec_number not in ec_numbers:
+                ec_numbers.add(ec_number)
+                new_ec.append((ec_number, complete))
+        con.executemany(query_uniprot, accessions)
+        con.executemany(query_joint_table, ((accession, ec_number) for accession, ec_number, _ in batch))
+        count += len(batch)
+
+    con.executemany(f"INSERT INTO {ec_table} (number, complete) VALUES(?, ?)", sorted(new_ec))
+    con.commit()
+    duplicates = create_indexes(con, indexes, logger)
+    if not count:
+        logger.error("Table could not be read or is empty")
     logger.info("Finished updating table")
+    return {"rows": count, "new_ec": len(new_ec), "duplicates": duplicates}
 
 
-def explorenz_ec(filename: str, database: str, logger):
+def explorenz_ec(filename: str, con, logger, delta=False):
     """
     Initialize the enzyme table with the info from the parsing
 
     Args:
-        filename: path and name of the parsing file (pickle format)
-        database: path and name of the database to be updated
+        filename: path and name of the parsing file (Arrow file, see columnar.py)
+        con: connection to the database to be updated
+        delta: only apply the differences with the table (see fill_table)
+    Returns:
+        The report of the source
     """
     logger.info("Start updating")
     table = "orenza_enzyme"
-    con = utils.create_connection(database, logger)
-    if not con:
-        sys.exit()
-    cur = con.cursor()
-    if cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})"):
-        cur.execute(f"DELETE FROM {table}")
-        con.commit()
-
-    logger.info("Start loading data")
-    enzyme_data = utils.load_pickle(filename, logger)
 
     logger.info("Start populating table")
-    if enzyme_data:
-        for key in enzyme_data:
-            ec_number = key
-            reaction = enzyme_data[key]["reaction"]
-            comments = enzyme_data[key]["comments"]
-            orphan = True
-            sprot_count = 0
-            trembl_count = 0
-            pdb_count = 0
-            species_count = 0
-            created = enzyme_data[key]["created"]
-            first_number = enzyme_data[key]["class"]
-            second_number = enzyme_data[key]["subclass"]
-            third_number = enzyme_data[key]["subsubclass"]
-            common_name = enzyme_data[key]["accepted_name"]
-            systematic_name = enzyme_data[key]["sys_name"]
-            other_name = enzyme_data[key]["other_names"]
-
-            query = f"""
-                        INSERT INTO {table} (ec_number, reaction, comments, orphan, sprot_count, 
-                                             trembl_count, pdb_count, species_count, created, first_number, second_number, third_number, common_name, systematic_name, other_name)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """
-            cur.execute(
-                query,
-                (
-                    ec_number,
-                    reaction,
-                    comments,
-                    orphan,
-                    sprot_count,
-                    trembl_count,
-                    pdb_count,
-                    species_count,
-                    created,
-                    first_number,
-                    second_number,
-                    third_number,
-                    common_name,
-                    systematic_name,
-                    other_name,
-                ),
-            )
-
-        con.commit()
-        con.close()
-    else:
-        logger.error("Pickle could not be read")
+    columns = ["ec_number", "reaction", "comments", "created", "class", "subclass", "subsubclass",
+               "accepted_name", "sys_name", "other_names"]
+    rows = list(columnar.read_rows(filename, logger, columns=columns))
+    count = len(rows)
+    tables = {table: fill_table(con, table, rows, logger, delta)}
+    if not count:
+        logger.error("Table could not be read or is empty")
     logger.info("Finished populating table")
+    return {"rows": count, "tables": tables}
 
 
-def explorenz_nomenclature(filename: str, database: str, logger):
+def explorenz_nomenclature(filename: str, con, logger, delta=False):
     """
     Populate nomenclature table with information from explorenz parsing
     Args:
-        filename: path and name of the parsing file (pickle format)
-        database: path and name of the database to be updated
+        filename: path and name of the parsing file (Arrow file, see columnar.py)
+        con: connection to the database to be updated
+        delta: only apply the differences with the table (see fill_table)
+    Returns:
+        The report of the source
     """
     logger.info("Start updating nomenclature table")
     table = "orenza_nomenclature"
-    con = utils.create_connection(database, logger)
-
-    if not con:
-        sys.exit()
-    cur = con.cursor()
-    if cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})"):
-        cur.execute(f"DELETE FROM {table}")
-        con.commit()
-
-    logger.info("Start loading data")
-    nomenclature_data = utils.load_pickle(filename, logger)
 
     logger.info("Start creating table")
-    if nomenclature_data:
-        for key in nomenclature_data:
-            ec_number = key
-            heading = nomenclature_data[key]["heading"]
-            first_number = nomenclature_data[key]["first_number"]
-            second_number = nomenclature_data[key]["second_number"]
-            third_number = nomenclature_data[key]["third_number"]
-            query = f"""
-                        INSERT INTO {table} (ec_number, heading, first_number, second_number, third_number)
-                        VALUES (?, ?, ?, ?, ?)
-                        """
-            cur.execute(
-                query,
-                (
-                    ec_number,
-                    heading,
-                    first_number,
-                    second_number,
-                    third_number,
-                ),
-            )
-
-        con.commit()
-        con.close()
-    else:
-        logger.error("Pickle could not be read")
+    # data structure : (ec_number, heading, first_number, second_number, third_number)
+    rows = list(columnar.read_rows(filename, logger))
+    count = len(rows)
+    tables = {table: fill_table(con, table, rows, logger, delta)}
+    if not count:
+        logger.error("Table could not be read or is empty")
     logger.info("Finished updating nomenclature table")
+    return {"rows": count, "tables": tables}
 
 
-def brenda(filename: str, database: str, logger):
+def brenda(filename: str, con, logger, delta=False):
     """
     Initialize the  species table with the info of the parsing
-    and the joint table between enzyme and this one
+    and the joint table between enzyme and this one, and fill the
+    cofactors of the enzyme table
 
     Args:
-        filename: the name and path of the data to be added to the database (pickle format)
-        database: the name and path of the database to be updated
+        filename: the name and path of the data to be added to the database (Arrow file, see columnar.py)
+        con: connection to the database to be updated
+        delta: only apply the differences with the tables (see fill_table)
+    Returns:
+        The report of the source
     """
     logger.info("Start updating table")
     table = "orenza_species"
     joint_table = "orenza_species_enzymes"
     enzyme_table = "orenza_enzyme"
 
-    con = utils.create_connection(database, logger)
-
-    if not con:
-        sys.exit()
-    cur = con.cursor()
-    if cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})"):
-        cur.execute(f"DELETE FROM {table}")
-        cur.execute(f"DELETE FROM {joint_table}")
-        con.commit()
-
-    logger.info("Start loading data")
-    brenda_data = utils.load_pickle(filename, logger)
-
     logger.info("Start creating table")
-    if brenda_data:
-        invalid_ec = []
-        for key in brenda_data:
-            ec_number = key
-            species = brenda_data[key]["species"]
-            query_ec_exist = f"SELECT EXISTS (SELECT 1 FROM {enzyme_table} WHERE ec_number =?)"
-            cur.execute(query_ec_exist, (ec_number,))
-            ec_exists = cur.fetchone()[0]
-            if ec_exists:
-                for specie in species:
-                    query_name_exist = f"SELECT EXISTS (SELECT 1 FROM {table} WHERE name=?)"
-                    cur.execute(query_name_exist, (specie,))
-                    name_exists = cur.fetchone()[0]
-                    if not name_exists:
-                        query_insert = f"""
-                                INSERT INTO {table} (name)
-                                VALUES (?)
-                                """
-                        cur.execute(
-                            query_insert,
-                            (specie,),
-                        )
-
-                    query_joint_table = f"""INSERT INTO {joint_table} (species_id, enzyme_id) VALUES (?, ?)"""
-                    cur.execute(query_joint_table, (specie, ec_number))
-
-            if not ec_exists:
-                invalid_ec.append(ec_number)
-
-        con.commit()
-        con.close()
-        print(invalid_ec)
-        #logger.info("List of invalid ec (ec not updated to the current number to explorenz current notation):", invalid_ec)
-    else:
-        logger.error("Pickle could not be read")
-
+    indexes = [] if delta else drop_indexes(con, [joint_table], logger)
+    enzymes = load_keys(con, enzyme_table, "ec_number")
+    species_names = set()
+    count = 0
+    invalid_ec = Counter()
+    for ec_number, species in columnar.read_rows(filename, logger, columns=["ec_number", "species"]):
+        count += 1
+        if ec_number not in enzymes:
+            invalid_ec[ec_number] += 1
+            continue
+        species_names.update(species)
+
+    tables = {}
+    # inserted in the order of the primary key
+    tables[table] = fill_table(con, table, ((specie,) for specie in sorted(species_names)), logger, delta)
+
+    links = columnar.read_rows(filename, logger, columns=["ec_number", "species"])
+    joint_rows = ((specie, ec) for ec, species in links if ec in enzymes for specie in species)
+    tables[joint_table] = fill_table(con, joint_table, joint_rows, logger, delta)
+
+    cofactors = {}
+    for values, ec in columnar.read_rows(filename, logger, columns=["cofactors", "ec_number"]):
+        if values and ec in enzymes:
+            cofactors[ec] = "; ".join(values)
+
+    # every enzyme gets a value, so that the cofactors brenda no longer gives are cleared as when the table is loaded again
+    query_cofactors = f"UPDATE {enzyme_table} SET cofactors = ? WHERE ec_number = ? AND cofactors IS NOT ?"
+    cofactor_rows = ((cofactors.get(ec), ec, cofactors.get(ec)) for ec in sorted(enzymes))
+    cur = con.executemany(query_cofactors, cofactor_rows)
+    tables[enzyme_table] = {"inserted": 0, "updated": max(cur.rowcount, 0), "deleted": 0}
+    con.commit()
+    duplicates = create_indexes(con, indexes, logger)
+
+    if not count:
+        logger.error("Table could not be read or is empty")
     logger.info("Finished updated table")
+    report = invalid_report(count, invalid_ec, logger)
+    report["duplicates"] = duplicates
+    report["tables"] = tables
+    return report
 
 
-def kegg(filename: str, database: str, logger):
+def kegg(filename: str, con, logger, delta=False):
     """
     Initialize the  kegg table with the info of the scraping of kegg pathway page
     Args:
-        filename: the name and path of the data to be added to the database (pickle format)
-        database: the name and path of the database to be updated
+        filename: the name and path of the data to be added to the database (Arrow file, see columnar.py)
+        con: connection to the database to be updated
+        delta: only apply the differences with the tables (see fill_table)
+    Returns:
+        The report of the source
     """
     logger.info("Start updating table")
     table = "orenza_kegg"
     joint_table = "orenza_kegg_enzymes"
     enzyme_table = "orenza_enzyme"
-    con = utils.create_connection(database, logger)
-
-    if not con:
-        sys.exit()
-    cur = con.cursor()
-    if cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})"):
-        cur.execute(f"DELETE FROM {table}")
-        cur.execute(f"DELETE FROM {joint_table}")
-        con.commit()
-
-    logger.info("Start loading data")
-    kegg_data = utils.load_pickle(filename, logger)
 
     logger.info("Start creating table")
-    if kegg_data:
-        invalid_ec = []
-        for pathway_class in kegg_data:
-            for pathway in kegg_data[pathway_class]:
-                ec_numbers = kegg_data[pathway_class][pathway]
-                query_pathway_exist = f"SELECT EXISTS (SELECT 1 FROM {table} WHERE pathway=?)"
-                cur.execute(query_pathway_exist, (pathway,))
-                pathway_exists = cur.fetchone()[0]
-                if not pathway_exists:
-                    query_insert = f"""
-                            INSERT INTO {table} (pathway, pathway_class)
-                            VALUES (?, ?)
-                            """
-                    cur.execute(
-                        query_insert,
-                        (pathway, pathway_class),
-                    )
-                for ec in ec_numbers:
-                    query_ec_exist = f"SELECT EXISTS (SELECT 1 FROM {enzyme_table} WHERE ec_number =?)"
-                    cur.execute(query_ec_exist, (ec,))
-                    ec_exists = cur.fetchone()[0]
-                    if ec_exists:
-                        query_joint_table = f"""INSERT INTO {joint_table} (kegg_id, enzyme_id) VALUES (?, ?)"""
-                        cur.execute(query_joint_table, (pathway, ec))
-
-                    if not ec_exists:
-                        invalid_ec.append(ec)
-
-        con.commit()
-        con.close()
-        print(invalid_ec)
-        #logger.info("List of invalid ec (ec not updated to the current number to explorenz current notation):", invalid_ec)
-    else:
-        logger.error("Pickle could not be read")
-
+    indexes = [] if delta else drop_indexes(con, [joint_table], logger)
+    enzymes = load_keys(con, enzyme_table, "ec_number")
+    pathways = {}
+    links = []
+    count = 0
+    invalid_ec = Counter()
+    # rows sorted by pathway class and pathway, data structure : (pathway_class, pathway, ec_number)
+    for pathway_class, pathway, ec in columnar.read_rows(filename, logger):
+        count += 1
+        # the first class of a pathway is kept
+        pathways.setdefault(pathway, pathway_class)
+        if ec in enzymes:
+            links.append((pathway, ec))
+        else:
+            invalid_ec[ec] += 1
+
+    tables = {}
+    # inserted in the order of the keys
+    tables[table] = fill_table(con, table, sorted(pathways.items()), logger, delta)
+    tables[joint_table] = fill_table(con, joint_table, sorted(links), logger, delta)
+    duplicates = create_indexes(con, indexes, logger)
+
+    if not count:
+        logger.error("Table could not be read or is empty")
     logger.info("Finished updating table")
+    report = invalid_report(count, invalid_ec, logger)
+    report["duplicates"] = duplicates
+    report["tables"] = tables
+    return report
 
 
-def pdb(filename: str, database: str, logger):
+def pdb(filename: str, con, logger, delta=False):
     """
     Initialize the  pdb table with the info of the parsed files of the pdb
     Args:
-        filename: the name and path of the data to be added to the database (pickle format)
-        database: the name and path of the database to be updated
+        filename: the name and path of the data to be added to the database (Arrow file, see columnar.py)
+        con: connection to the database to be updated
+        delta: only apply the differences with the table (see fill_table)
+    Returns:
+        The report of the source
     """
     logger.info("Start updating table")
     table = "orenza_pdb"
     enzyme_table = "orenza_enzyme"
-    con = utils.create_connection(database, logger)
+    logger.info("Start creating table")
+    indexes = [] if delta else drop_indexes(con, [table], logger)
+    enzymes = load_keys(con, enzyme_table, "ec_number")
+    accessions = set()
+    rows = []
+    count = 0
+    duplicates = 0
+    invalid_ec = Counter()
+    # rows sorted by ec number, data structure : (ec_number, pdb id, uniprot accession, entity id)
+    for ec_number, pdb_id, uniprot_accession in columnar.read_rows(
+        filename, logger, columns=["ec_number", "pdb_id", "uniprot_accession"]
+    ):
+        count += 1
+        if ec_number not in enzymes:
+            invalid_ec[ec_number] += 1
+        # a pdb id can hold several ec numbers but is the primary key of the table, only its first row is kept
+        elif pdb_id in accessions:
+            duplicates += 1
+        else:
+            accessions.add(pdb_id)
+            rows.append((pdb_id, uniprot_accession, ec_number))
+
+    # inserted in the order of the primary key
+    tables = {table: fill_table(con, table, sorted(rows), logger, delta)}
+    create_indexes(con, indexes, logger)
+
+    if duplicates:
+        logger.warning(f"{duplicates} rows skipped, their pdb id is already in the table")
+    if not count:
+        logger.error("Table could not be read or is empty")
+    logger.info("Finished updating table")
+    report = invalid_report(count, invalid_ec, logger)
+    report["duplicates"] = duplicates
+    report["tables"] = tables
+    return report
 
-    if not con:
-        sys.exit()
-    cur = con.cursor()
-    if cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})"):
-        cur.execute(f"DELETE FROM {table}")
-        con.commit()
-    logger.info("Start loading data")
-    pdb_data = utils.load_pickle(filename, logger)
 
-    logger.info("Start creating table")
-    if pdb_data:
-        invalid_ec = []
-        for key in pdb_data:
-            ec_number = key
-            id_tuple = pdb_data[key]
-            query_ec_exist = f"SELECT EXISTS (SELECT 1 FROM {enzyme_table} WHERE ec_number=?)"
-            cur.execute(query_ec_exist, (ec_number,))
-            ec_exists = cur.fetchone()[0]
-            if not ec_exists:
-                invalid_ec.append(ec_number)
-            else:
-                for tup in id_tuple:
-                    query_table = f"""INSERT INTO {table} (accession, uniprot_accession, ec_number_id) VALUES (?, ?, ?)"""
-                    cur.execute(query_table, (tup[0], tup[1], ec_number))
+def populate_source(source: str, filename: str, con, logger, delta=False):
+    """
+    Fill the tables of a source loaded after explorenz (see SOURCE_TABLES)
 
+    Args:
+        source: name of the source
+        filename: the name and path of the parsed data (Arrow file, see columnar.py)
+        con: connection to the database to be updated
+        delta: only apply the differences with the tables (see fill_table)
+    Returns:
+        The report of the source
+    """
+    if source in ["sprot", "trembl"]:
+        return uniprot(filename, con, source, logger, delta)
+    functions = {"kegg": kegg, "brenda": brenda, "pdb": pdb}
+    if source not in functions:
+        raise ValueError(f"Invalid source {source}. Allowed values are {', '.join(SOURCE_TABLES)}.")
+    return functions[source](filename, con, logger, delta)
+
+
+def shard_template(database: str, template_file: str, logger):
+    """
+    Take the snapshot of the database the shards start from (see build_shard): the tables of the sources
+    and orenza_ec without their indexes nor rows, and a copy of orenza_enzyme. The database is opened
+    read-only, it is not to be written while the snapshot is taken. The cofactors of the copy are cleared,
+    only those given by brenda are set in its shard.
+
+    Args:
+        database: the name and path of the database holding the schema and the enzyme table
+        template_file: the name and path of the snapshot, replaced if it exists
+    """
+    if not os.path.exists(database):
+        raise FileNotFoundError(f"The database {database} holding the schema of the shards does not exist")
+    if os.path.exists(template_file):
+        os.remove(template_file)
+    con = sqlite3.connect(template_file, uri=True)
+    try:
+        # read-only, so that a missing file is never created
+        con.execute("ATTACH DATABASE ? AS base", (f"file:{quote(os.path.abspath(database))}?mode=ro",))
+        tables = [table for source_tables in SOURCE_TABLES.values() for table in source_tables]
+        for table in tables + ["orenza_ec", "orenza_enzyme"]:
+            query = "SELECT sql FROM base.sqlite_master WHERE type = 'table' AND name = ?"
+            row = con.execute(query, (table,)).fetchone()
+            if row is None:
+                raise sqlite3.OperationalError(f"No table {table} in {database}")
+            con.execute(row[0])
+        con.execute("INSERT INTO main.orenza_enzyme SELECT * FROM base.orenza_enzyme")
+        # the cofactors of the brenda shard are compared to the ones of the database by merge_shard
+        con.execute("UPDATE main.orenza_enzyme SET cofactors = NULL")
         con.commit()
+        con.execute("DETACH DATABASE base")
+    finally:
         con.close()
-        print(invalid_ec)
-        #logger.info("List of invalid ec (ec not updated to the current number to explorenz current notation):", invalid_ec)
-    else:
-        logger.error("Pickle could not be read")
+    logger.info(f"Shard template {template_file} taken from {database}")
 
-    logger.info("Finished updating table")
+
+def build_shard(source: str, filename: str, template_file: str, shard_file: str, cache_size: int, logger, batches=None):
+    """
+    Fill the tables of a source in a scratch database of their own, so that the sources can be
+    loaded at the same time by several processes. The shard is a copy of a snapshot of the database
+    (see shard_template), whose ec numbers are checked and cofactors updated, the database itself
+    is never opened. It is then merged in the database by merge_shard.
+
+    Args:
+        source: name of the source
+        filename: the name and path of the parsed data (Arrow file, see columnar.py)
+        template_file: the name and path of the snapshot of the database (see shard_template), only read
+        shard_file: the name and path of the shard, replaced if it exists
+        cache_size: size in bytes of the page cache of the connection
+        batches: batches of rows of sprot or trembl read instead of filename (see uniprot_stream)
+    Returns:
+        The report of the source
+    """
+    if not os.path.exists(template_file):
+        raise FileNotFoundError(f"The shard template {template_file} does not exist")
+    shutil.copyfile(template_file, shard_file)
+    con = utils.create_connection(shard_file, logger)
+    if not con:
+        raise sqlite3.OperationalError(f"Could not open the shard {shard_file}")
+    try:
+        utils.set_bulk_load(con, cache_size, logger)
+        if batches is not None:
+            return uniprot_stream(batches, con, source, logger)
+        return populate_source(source, filename, con, logger)
+    finally:
+        con.close()
+
+
+def merge_shard(con, source: str, shard_file: str, logger, delta=False):
+    """
+    Replace the tables of a source by the ones of its shard (see build_shard), or with delta only
+    apply the differences (see sync_table). The ec numbers of uniprot that are not in orenza_ec yet
+    are added and the cofactors of brenda are copied.
+
+    Args:
+        con: connection to the database to be updated
+        source: name of the source
+        shard_file: the name and path of the shard
+        delta: only apply the differences between the tables and the shard
+    Returns:
+        The part of the report of the source given by the merge (rows inserted, updated and deleted per table...)
+    """
+    logger.info(f"Merging the {source} shard")
+    con.execute("ATTACH DATABASE ? AS shard", (shard_file,))
+    try:
+        indexes = [] if delta else drop_indexes(con, SOURCE_TABLES[source], logger)
+        tables = {}
+        for table in SOURCE_TABLES[source]:
+            if delta:
+                keys = TABLE_COLUMNS[table][1]
+                con.execute(f"CREATE INDEX shard.{table}_keys ON {table} ({', '.join(keys)})")
+                tables[table] = sync_table(con, table, f"shard.{table}", logger)
+            else:
+                deleted = con.execute(f"DELETE FROM main.{table}").rowcount
+                inserted = con.execute(f"INSERT INTO main.{table} SELECT * FROM shard.{table}").rowcount
+                tables[table] = {"inserted": inserted, "updated": 0, "deleted": deleted}
+        report = {"tables": tables}
+        if source in ["sprot", "trembl"]:
+            # the first source giving an ec number sets its completeness, as in uniprot
+            query_ec = "INSERT OR IGNORE INTO main.orenza_ec SELECT * FROM shard.orenza_ec"
+            report["new_ec"] = con.execute(query_ec).rowcount
+        if source == "brenda":
+            updated = con.execute(
+                """UPDATE main.orenza_enzyme SET cofactors = copy.cofactors FROM shard.orenza_enzyme AS copy
+                   WHERE copy.ec_number = orenza_enzyme.ec_number AND copy.cofactors IS NOT orenza_enzyme.cofactors"""
+            ).rowcount
+            tables["orenza_enzyme"] = {"inserted": 0, "updated": updated, "deleted": 0}
+        con.commit()
+        report["duplicates"] = create_indexes(con, indexes, logger)
+    finally:
+        con.execute("DETACH DATABASE shard")
+    logger.info(f"Finished merging the {source} shard")
+    return report
@@ -0,0 +1,221 @@
+import random
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import sleep, monotonic
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+# status codes meaning that the server wants us to slow down
+THROTTLE_STATUS = (429, 503)
+
+
+class TokenBucket:
+    """
+    Limit the rate of requests: each request takes a token, tokens are refilled at rate per second
+    up to burst tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class Host:
+    """
+    Limits and counters of a host
+    """
+
+    def __init__(self, concurrency, rate, burst=None):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.counters = {"waiting": 0, "active": 0, "requests": 0, "throttled": 0, "errors": 0}
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def pause(self, delay):
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + delay)
+
+
+class Scheduler:
+    """
+    Every network access goes through a scheduler, which enforces per host a maximum number of
+    concurrent requests (concurrency) and of requests per second (rate), and backs off when a host
+    asks for it (429/503 with Retry-After). The limits are shared by the threads of a process only,
+    the steps run as separate processes (see update.sh) are not coordinated.
+
+    Args:
+        default: limits of the hosts not listed in hosts, e.g. {"concurrency": 8, "rate": 10}
+        hosts: dictionary {host name: limits}
+    """
+
+    def __init__(self, default=None, hosts=None):
+        self.default = {"concurrency": 8, "rate": 10, **(default or {})}
+        self.settings = hosts or {}
+        self.hosts = {}
+        self.lock = threading.Lock()
+        pool_size = max([self.default["concurrency"]] + [h.get("concurrency", 0) for h in self.settings.values()])
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def host(self, name):
+        if "://" in name:
+            name = urlparse(name).hostname
+        with self.lock:
+            if name not in self.hosts:
+                settings = {**self.default, **self.settings.get(name, {})}
+                self.hosts[name] = Host(settings["concurrency"], settings["rate"], settings.get("burst"))
+            return self.hosts[name]
+
+    @contextmanager
+    def slot(self, name):
+        """
+        Wait for the host limits to allow one more request and hold the slot until the end of the block.
+        Args:
+            name: host name or url
+        """
+        host = self.host(name)
+        host.count("waiting")
+        host.semaphore.acquire()
+        try:
+            delay = host.paused_until - monotonic()
+            if delay > 0:
+                sleep(delay)
+            host.bucket.acquire()
+        except BaseException:
+            host.semaphore.release()
+            host.count("waiting", -1)
+            raise
+        host.count("waiting", -1)
+        host.count("active")
+        host.count("requests")
+        try:
+            yield host
+        finally:
+            host.count("active", -1)
+            host.semaphore.release()
+
+    @contextmanager
+    def stream(self, method, url, retries=3, backoff_factor=0.3, session=None, **kwargs):
+        """
+        Send a request, retrying with a jittered exponential backoff on connection and server errors,
+        and waiting as long as asked by Retry-After. The host slot is held until the end of the block so that the body can
+        be streamed.
+        Args:
+            method: http method
+            url: url of the request
+            retries: number of attempts
+            backoff_factor: time factor for the exponential backoff
+            session: session to use, the scheduler session (connections kept alive) if None
+            kwargs: arguments of requests.request
+        Yield:
+            the last response (its status is not checked), raise the last exception if there was no response
+        """
+        session = session or self.session
+        kwargs.setdefault("timeout", 60)
+        host = self.host(url)
+        for i in range(retries):
+            delay = backoff_factor * (2**i) * random.uniform(0.5, 1.5)
+            last_attempt = i == retries - 1
+            with self.slot(url):
+                try:
+                    response = session.request(method, url, **kwargs)
+                except requests.RequestException:
+                    host.count("errors")
+                    if last_attempt:
+                        raise
+                    response = None
+                if response is not None:
+                    retryable = response.status_code in THROTTLE_STATUS or response.status_code >= 500
+                    if not retryable or last_attempt:
+                        try:
+                            yield response
+                        finally:
+                            response.close()
+                        return
+                    if response.status_code in THROTTLE_STATUS:
+                        host.count("throttled")
+                        delay = max(delay, retry_after(response) * random.uniform(1, 1.2))
+                        host.pause(delay)
+                    else:
+                        host.count("errors")
+                    response.close()
+            sleep(delay)
+
+    def request(self, method, url, **kwargs):
+        """
+        Same as stream but returns the response with its body loaded.
+        """
+        with self.stream(method, url, **kwargs) as response:
+            response.content
+            return response
+
+    def metrics(self):
+        """
+        Returns:
+            dictionary {host: {"waiting": queue depth, "active", "requests", "throttled", "errors"}}
+        """
+        with self.lock:
+            return {name: dict(host.counters) for name, host in self.hosts.items()}
+
+    def log_metrics(self, logger):
+        for name, counters in self.metrics().items():
+            logger.info(f"{name}: " + ", ".join(f"{key}={value}" for key, value in counters.items()))
+
+
+def retry_after(response):
+    """
+    Returns:
+        the delay in seconds asked by the Retry-After header of the response, 0 if there is none
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return 0
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0
+
+
+scheduler = Scheduler()
+
+
+def configure(settings):
+    """
+    Replace the shared scheduler with one using the limits of the config (see config_example.yaml)
+    """
+    global scheduler
+    settings = settings or {}
+    scheduler = Scheduler(settings.get("default"), settings.get("hosts"))
+
+
+def get_scheduler():
+    return scheduler
@@ -1,20 +1,31 @@
-import requests
 import re
+import os
 from bs4 import BeautifulSoup
+import columnar
+import scheduler
 import utils
 from urllib.parse import urlparse
 
 
-def kegg(url: str, output_file: str, logger):
+def kegg(url: str, output_file: str, logger, fingerprint_file=None, force=False):
     """
     Scrape the kegg pages containing the pathway and go through each pages to get all the ec ec_number
     contained in the rectangle (html shape)
     Args:
         url: main page contained the pathway
         output_file: name and location of the result
+        fingerprint_file: if given, the scraping is skipped when the main page did not change
+                          since the recorded fingerprint and output_file exists
+        force: scrape even if the main page did not change
+    Returns:
+        True if the pages were scraped, False if skipped
     """
-    r = requests.get(url)
+    r = scheduler.get_scheduler().request("GET", url)
     html_data = r.content
+    fingerprint = utils.page_fingerprint(r)
+    if fingerprint_file and not force and os.path.exists(output_file) and utils.is_unchanged(fingerprint, fingerprint_file, logger):
+        logger.info("kegg pathway page unchanged, skipping scraping")
+        return False
     parsed_data = BeautifulSoup(html_data, "html.parser")
     parsed_url = urlparse(url)
     list_elements = parsed_data.find_all(class_="list")
@@ -31,7 +42,7 @@ def kegg(url: str, output_file: str, logger):
         for link in links:
             link_text = link.get_text(strip=True)
             if link["href"].startswith("/pathway/"):
-                r_path = requests.get(base_url + link["href"])
+                r_path = scheduler.get_scheduler().request("GET", base_url + link["href"])
                 html_pathway = r_path.content
                 parsed_pathway = BeautifulSoup(html_pathway, "html.parser")
                 rects = parsed_pathway.find_all(shape="rect")
@@ -49,4 +60,7 @@ def kegg(url: str, output_file: str, logger):
                                 data[pathway_class_name][full_pathway] = []
                             if ec_number not in data[pathway_class_name][full_pathway]:
                                 data[pathway_class_name][full_pathway].append(ec_number)
-    utils.save_pickle(data=data, output_file=output_file, logger=logger)
+    columnar.save("kegg", data, output_file, logger)
+    if fingerprint_file:
+        utils.save_fingerprint(fingerprint, fingerprint_file, logger)
+    return True
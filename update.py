@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 import os
+import sys
 import yaml
+import cache
+import columnar
 import download
 import parse
+import pipeline
 import populate
 import link
 import scraping
+import scheduler
+import utils
 import concurrent.futures
 import customLog
 import argparse
@@ -15,34 +21,57 @@ with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),"config.yaml")
 
 logger = customLog.get_logger()
 
-def dl_explorenz(output_folder,overwrite=False):
+def uniprot_checksum(remote_file):
+    """size and md5 of a uniprot file published with the release, None if unknown"""
+    if not config["uniprot"].get("checksum_file"):
+        return None
+    checksums = download.uniprot_checksums(config["uniprot"]["ftp"], config["uniprot"]["checksum_file"], logger)
+    return checksums.get(os.path.basename(remote_file))
+
+
+def dl_explorenz(output_folder,overwrite=False,force=False):
     """download explorenz data"""
     global config
     global logger
 
     explorenz_url = config["explorenz"]["url"]
     explorenz_data_compressed = os.path.join(output_folder, "data", config["explorenz"]["output_file"])
-    explorenz_data_uncompressed = os.path.splitext(explorenz_data_compressed)[0]  # remove the compressed extension
-    explorenz_ec_pickle = os.path.join(output_folder, "data", "explorenz_ec.pickle")
-    explorenz_nomenclature_pickle = os.path.join(output_folder, "data", "explorenz_nomenclature.pickle")
-    explorenz_file_delete = [explorenz_data_compressed, explorenz_data_uncompressed]
+    explorenz_ec_arrow = os.path.join(output_folder, "data", "explorenz_ec.arrow")
+    explorenz_nomenclature_arrow = os.path.join(output_folder, "data", "explorenz_nomenclature.arrow")
+    explorenz_fingerprint = os.path.join(output_folder, "data", "explorenz_release.json")
+    explorenz_file_delete = [explorenz_data_compressed]
 
-    if not (not os.path.exists(explorenz_ec_pickle) or not os.path.exists(explorenz_nomenclature_pickle) or overwrite):
+    if not (not os.path.exists(explorenz_ec_arrow) or not os.path.exists(explorenz_nomenclature_arrow) or overwrite):
         logger.info("dl_explorenz nothing to be done")
         return
-    
+
+    release = download.http_fingerprint(explorenz_url, logger)
+    if (os.path.exists(explorenz_ec_arrow) and os.path.exists(explorenz_nomenclature_arrow)
+            and not force and utils.is_unchanged(release, explorenz_fingerprint, logger)):
+        logger.info("dl_explorenz upstream release unchanged, nothing to be done")
+        return
+
     logger = customLog.set_context(logger, "explorenz")
     logger.info("Start of the download")
-    download.http(url=explorenz_url, filename=explorenz_data_compressed, logger=logger)
-    parse.gunzip_file(input_file=explorenz_data_compressed, output_file=explorenz_data_uncompressed, logger=logger)
+    # retried by the scheduler, a corrupt download is quarantined and fetched again on the next run
+    if not download.http(url=explorenz_url, filename=explorenz_data_compressed, logger=logger,
+                         quarantine_folder=os.path.join(config["output"], "quarantine")):
+        sys.exit(1)
     logger.info("Start of parsing")
-    parse.explorenz_ec(input_file=explorenz_data_uncompressed, output_file=explorenz_ec_pickle, logger=logger)
-    # [CQ]: outputs a dict of {EC number: {infos}}, e.g. obj['1.1.1.1'] = {'accepted_name': 'alcohol dehydrogenase', 'reaction': '(1) a primary alcohol + NAD+[...]', 'other_names': 'aldehyde reductase; ADH; [...]', 'sys_name': 'alcohol:NAD+ oxidoreductase', 'comments': 'A zinc protein. Acts on primary [...]', 'links': 'BRENDA, EAWAG-BBD, EXPASY, GENE, GTD, KEGG, PDB', 'class': '1', 'subclass': '1', 'subsubclass': '1', 'serial': '1', 'status': None, 'diagram': 'For diagram of mevalonate biosynthesis, {terp/MVA}', 'cas_num': '9031-72-5', 'glossary': None, 'last_change': '2024-05-20 13:03:28', 'id': '1', 'created': '1961'}
-    parse.explorenz_nomenclature(
-        input_file=explorenz_data_uncompressed, output_file=explorenz_nomenclature_pickle, logger=logger
+    cache.cached(
+        "explorenz", parse.PARSER_VERSIONS["explorenz"], [cache.file_digest(explorenz_data_compressed)],
+        [explorenz_ec_arrow, explorenz_nomenclature_arrow],
+        lambda: parse.explorenz(
+            input_file=explorenz_data_compressed, ec_output_file=explorenz_ec_arrow,
+            nomenclature_output_file=explorenz_nomenclature_arrow, logger=logger
+        ),
+        logger,
+        force=force,
     )
+    # [CQ]: outputs a dict of {EC number: {infos}}, e.g. obj['1.1.1.1'] = {'accepted_name': 'alcohol dehydrogenase', 'reaction': '(1) a primary alcohol + NAD+[...]', 'other_names': 'aldehyde reductase; ADH; [...]', 'sys_name': 'alcohol:NAD+ oxidoreductase', 'comments': 'A zinc protein. Acts on primary [...]', 'links': 'BRENDA, EAWAG-BBD, EXPASY, GENE, GTD, KEGG, PDB', 'class': '1', 'subclass': '1', 'subsubclass': '1', 'serial': '1', 'status': None, 'diagram': 'For diagram of mevalonate biosynthesis, {terp/MVA}', 'cas_num': '9031-72-5', 'glossary': None, 'last_change': '2024-05-20 13:03:28', 'id': '1', 'created': '1961'}
     # [CQ]: outputs a dict of {pseudo EC number: {infos}}, with all combinations of '?.?.?.-' e.g. obj['1.1.2.-'] = {'first_number': '1', 'second_number': '1', 'third_number': '2', 'heading': 'With a cytochrome as acceptor'}
-    
+    utils.save_fingerprint(release, explorenz_fingerprint, logger)
+
     # clean up
     for file in explorenz_file_delete:
         if os.path.isfile(file):
@@ -50,7 +79,26 @@ def dl_explorenz(output_folder,overwrite=False):
     logger.info("Done")
 
 
-def dl_sprot(output_folder,overwrite=False):
+def uniprot_pipeline(source,input_file,shard_file):
+    """Parse sprot or trembl straight into a shard of the database, merged by populate_db (see pipeline.py)"""
+    global config
+    global logger
+
+    # the empty database copied by populate, the database of the previous update may not exist yet
+    database = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_orenza.sqlite3")
+    template_file = f"{shard_file}.template"
+    cache_size = (config.get("populate") or {}).get("cache_size", 1 << 30)
+    populate.shard_template(database, template_file, logger)
+    try:
+        report = pipeline.stream(parse.uniprot_batches(input_file), populate.build_shard,
+                                 (source, None, template_file, shard_file, cache_size, logger),
+                                 logger, queue_size=config[source].get("queue_size", 8))
+    finally:
+        os.remove(template_file)
+    logger.info(f"{report['rows']} rows loaded in {shard_file}")
+
+
+def dl_sprot(output_folder,overwrite=False,force=False):
     """download sprot data"""    
     global config
     global logger
@@ -59,20 +107,73 @@ def dl_sprot(output_folder,overwrite=False):
     sprot_remote_file = config["sprot"]["remote_file"]
     sprot_data_compressed = os.path.join(output_folder, "data", config["sprot"]["output_file"])
     sprot_data_uncompressed = os.path.splitext(sprot_data_compressed)[0]
-    sprot_pickle = os.path.join(output_folder, "data", "sprot.pickle")
-    sprot_file_delete = [sprot_data_compressed, sprot_data_uncompressed]
-
-    if not (not os.path.exists(sprot_pickle) or overwrite):
+    sprot_arrow = os.path.join(output_folder, "data", "sprot.arrow")
+    # pipeline mode: the parser fills a shard of the database instead of an Arrow file (see pipeline.py)
+    sprot_pipeline = config["sprot"].get("pipeline", False)
+    sprot_shard = os.path.join(output_folder, "data", "sprot.shard")
+    sprot_parsed = sprot_shard if sprot_pipeline else sprot_arrow
+    sprot_fingerprint = os.path.join(output_folder, "data", "sprot_release.json")
+    sprot_file_delete = [sprot_data_compressed, sprot_data_uncompressed,
+                         sprot_data_compressed + ".gzidx", sprot_data_compressed + ".gzidx.json"]
+
+    if not (not os.path.exists(sprot_parsed) or overwrite):
         logger.info("dl_sprot nothing to be done")
         return
-    
+
+    release = download.ftp_fingerprint(config["uniprot"]["ftp"], config["uniprot"]["remote_file"], logger)
+    if os.path.exists(sprot_parsed) and not force and utils.is_unchanged(release, sprot_fingerprint, logger):
+        logger.info("dl_sprot upstream release unchanged, nothing to be done")
+        return
+
     logger = customLog.set_context(logger, "sprot")
-    logger.info("Start of the download")
-    download.ftp(ftp_host=sprot_ftp, remote_file=sprot_remote_file, local_file=sprot_data_compressed, logger=logger)
-    logger.info("Start of the extraction")
-    parse.gunzip_file(input_file=sprot_data_compressed, output_file=sprot_data_uncompressed, logger=logger)
-    logger.info("Start of the parsing")
-    parse.uniprot(input_file=sprot_data_uncompressed, output_file=sprot_pickle, logger=logger)
+    expected = uniprot_checksum(sprot_remote_file)
+    # the md5 published with the release identifies the content of the archive before its download
+    sprot_key = cache.entry_key(parse.PARSER_VERSIONS["uniprot"], [expected["md5"]]) if expected and expected.get("md5") else None
+    # the shards of the pipeline mode are not cached, --force parses again
+    if sprot_pipeline or force or not cache.fetch("sprot", sprot_key, [sprot_arrow], logger):
+        if config["sprot"].get("stream", False):
+            logger.info("Start of the download and parsing")
+            try:
+                with download.ftp_stream(ftp_host=sprot_ftp, remote_file=sprot_remote_file, logger=logger) as stream:
+                    verified_stream = download.VerifiedStream(stream)
+                    if sprot_pipeline:
+                        uniprot_pipeline("sprot", verified_stream, sprot_shard)
+                    else:
+                        parse.uniprot(input_file=verified_stream, output_file=sprot_arrow, logger=logger,
+                                      memory_budget=config["sprot"].get("memory_budget"))
+            except Exception as e:
+                logger.exception(f"Streaming exception: {e}")
+                sys.exit(1)
+            error = verified_stream.verifier.error(expected)
+            if error:
+                logger.error(f"Integrity check failed: {error}")
+                os.remove(sprot_parsed)
+                sys.exit(1)
+        else:
+            logger.info("Start of the download")
+            fetch = lambda: download.segmented_ftp(ftp_host=sprot_ftp, remote_file=sprot_remote_file, local_file=sprot_data_compressed,
+                                                   logger=logger, connections=config["sprot"].get("connections", 4))
+            if not download.verified(fetch, sprot_data_compressed, logger, expected,
+                                     quarantine_folder=os.path.join(config["output"], "quarantine")):
+                sys.exit(1)
+            sprot_worker = config["sprot"].get("worker", 1)
+            if sprot_pipeline:
+                logger.info("Start of the parsing and loading")
+                uniprot_pipeline("sprot", sprot_data_compressed, sprot_shard)
+            elif sprot_worker > 1 and parse.indexed_gzip is None:
+                # without a gzip index, the shards are byte ranges of the uncompressed file
+                logger.info("Start of the extraction")
+                parse.gunzip_file(input_file=sprot_data_compressed, output_file=sprot_data_uncompressed, logger=logger)
+                logger.info("Start of the parsing")
+                parse.uniprot(input_file=sprot_data_uncompressed, output_file=sprot_arrow, logger=logger, worker=sprot_worker,
+                              memory_budget=config["sprot"].get("memory_budget"))
+            else:
+                logger.info("Start of the parsing")
+                parse.uniprot(input_file=sprot_data_compressed, output_file=sprot_arrow, logger=logger, worker=sprot_worker,
+                              memory_budget=config["sprot"].get("memory_budget"))
+        if not sprot_pipeline:
+            cache.store("sprot", sprot_key, parse.PARSER_VERSIONS["uniprot"], [sprot_arrow], logger)
+    utils.save_fingerprint(release, sprot_fingerprint, logger)
 
     # clean up
     for file in sprot_file_delete:
@@ -81,7 +182,7 @@ def dl_sprot(output_folder,overwrite=False):
     logger.info("Done")
 
 
-def dl_trembl(output_folder,overwrite=False):
+def dl_trembl(output_folder,overwrite=False,force=False):
     """download trembl data"""  
     global config
     global logger
@@ -90,20 +191,73 @@ def dl_trembl(output_folder,overwrite=False):
     trembl_remote_file = config["trembl"]["remote_file"]
     trembl_data_compressed = os.path.join(output_folder, "data", config["trembl"]["output_file"])
     trembl_data_uncompressed = os.path.splitext(trembl_data_compressed)[0]
-    trembl_pickle = os.path.join(output_folder, "data", "trembl.pickle")
-    trembl_file_delete = [trembl_data_compressed, trembl_data_uncompressed]
-
-    if not (not os.path.exists(trembl_pickle) or overwrite):
+    trembl_arrow = os.path.join(output_folder, "data", "trembl.arrow")
+    # pipeline mode: the parser fills a shard of the database instead of an Arrow file (see pipeline.py)
+    trembl_pipeline = config["trembl"].get("pipeline", False)
+    trembl_shard = os.path.join(output_folder, "data", "trembl.shard")
+    trembl_parsed = trembl_shard if trembl_pipeline else trembl_arrow
+    trembl_fingerprint = os.path.join(output_folder, "data", "trembl_release.json")
+    trembl_file_delete = [trembl_data_compressed, trembl_data_uncompressed,
+                         trembl_data_compressed + ".gzidx", trembl_data_compressed + ".gzidx.json"]
+
+    if not (not os.path.exists(trembl_parsed) or overwrite):
         logger.info("dl_trembl nothing to be done")
         return
-    
+
+    release = download.ftp_fingerprint(config["uniprot"]["ftp"], config["uniprot"]["remote_file"], logger)
+    if os.path.exists(trembl_parsed) and not force and utils.is_unchanged(release, trembl_fingerprint, logger):
+        logger.info("dl_trembl upstream release unchanged, nothing to be done")
+        return
+
     logger = customLog.set_context(logger, "trembl")
-    logger.info("Start of the download")
-    download.ftp(ftp_host=trembl_ftp, remote_file=trembl_remote_file, local_file=trembl_data_compressed, logger=logger)
-    logger.info("Start of the extraction")
-    parse.gunzip_file(input_file=trembl_data_compressed, output_file=trembl_data_uncompressed, logger=logger)
-    logger.info("Start of the parsing")
-    parse.uniprot(input_file=trembl_data_uncompressed, output_file=trembl_pickle, logger=logger)
+    expected = uniprot_checksum(trembl_remote_file)
+    # the md5 published with the release identifies the content of the archive before its download
+    trembl_key = cache.entry_key(parse.PARSER_VERSIONS["uniprot"], [expected["md5"]]) if expected and expected.get("md5") else None
+    # the shards of the pipeline mode are not cached, --force parses again
+    if trembl_pipeline or force or not cache.fetch("trembl", trembl_key, [trembl_arrow], logger):
+        if config["trembl"].get("stream", False):
+            logger.info("Start of the download and parsing")
+            try:
+                with download.ftp_stream(ftp_host=trembl_ftp, remote_file=trembl_remote_file, logger=logger) as stream:
+                    verified_stream = download.VerifiedStream(stream)
+                    if trembl_pipeline:
+                        uniprot_pipeline("trembl", verified_stream, trembl_shard)
+                    else:
+                        parse.uniprot(input_file=verified_stream, output_file=trembl_arrow, logger=logger,
+                                      memory_budget=config["trembl"].get("memory_budget"))
+            except Exception as e:
+                logger.exception(f"Streaming exception: {e}")
+                sys.exit(1)
+            error = verified_stream.verifier.error(expected)
+            if error:
+                logger.error(f"Integrity check failed: {error}")
+                os.remove(trembl_parsed)
+                sys.exit(1)
+        else:
+            logger.info("Start of the download")
+            fetch = lambda: download.segmented_ftp(ftp_host=trembl_ftp, remote_file=trembl_remote_file, local_file=trembl_data_compressed,
+                                                   logger=logger, connections=config["trembl"].get("connections", 4))
+            if not download.verified(fetch, trembl_data_compressed, logger, expected,
+                                     quarantine_folder=os.path.join(config["output"], "quarantine")):
+                sys.exit(1)
+            trembl_worker = config["trembl"].get("worker", 1)
+            if trembl_pipeline:
+                logger.info("Start of the parsing and loading")
+                uniprot_pipeline("trembl", trembl_data_compressed, trembl_shard)
+            elif trembl_worker > 1 and parse.indexed_gzip is None:
+                # without a gzip index, the shards are byte ranges of the uncompressed file
+                logger.info("Start of the extraction")
+                parse.gunzip_file(input_file=trembl_data_compressed, output_file=trembl_data_uncompressed, logger=logger)
+                logger.info("Start of the parsing")
+                parse.uniprot(input_file=trembl_data_uncompressed, output_file=trembl_arrow, logger=logger, worker=trembl_worker,
+                              memory_budget=config["trembl"].get("memory_budget"))
+            else:
+                logger.info("Start of the parsing")
+                parse.uniprot(input_file=trembl_data_compressed, output_file=trembl_arrow, logger=logger, worker=trembl_worker,
+                              memory_budget=config["trembl"].get("memory_budget"))
+        if not trembl_pipeline:
+            cache.store("trembl", trembl_key, parse.PARSER_VERSIONS["uniprot"], [trembl_arrow], logger)
+    utils.save_fingerprint(release, trembl_fingerprint, logger)
 
     for file in trembl_file_delete:
         if os.path.isfile(file):
@@ -111,102 +265,200 @@ def dl_trembl(output_folder,overwrite=False):
     logger.info("Done")
 
 
-def dl_kegg(output_folder,overwrite=False):
+def dl_kegg(output_folder,overwrite=False,force=False):
     """download kegg data"""  
     global config
     global logger
 
     kegg_url = config["kegg"]["url"]
-    kegg_pickle = os.path.join(output_folder, "data", "kegg.pickle")
+    kegg_arrow = os.path.join(output_folder, "data", "kegg.arrow")
+    kegg_fingerprint = os.path.join(output_folder, "data", "kegg_release.json")
 
-    if not (not os.path.exists(kegg_pickle) or overwrite):
+    if not (not os.path.exists(kegg_arrow) or overwrite):
         logger.info("dl_kegg nothing to be done")
         return
     
     logger = customLog.set_context(logger, "kegg")
     logger.info("Start of scraping")
-    scraping.kegg(kegg_url, kegg_pickle, logger)
+    scraping.kegg(kegg_url, kegg_arrow, logger, fingerprint_file=kegg_fingerprint, force=force)
     logger.info("Done")
 
 
-def dl_brenda(output_folder,overwrite=False):
+def dl_brenda(output_folder,overwrite=False,force=False):
     """download brenda data"""      
     global config
     global logger
 
     brenda_data_compressed = config["brenda"]["compressed_file"]
-    brenda_data_uncompressed = os.path.join(output_folder, "data", os.path.basename(brenda_data_compressed.replace(".tar.gz", "")))
-    brenda_pickle = os.path.join(output_folder, "data", "brenda.pickle")
-    brenda_file_delete = [brenda_data_uncompressed]
+    brenda_arrow = os.path.join(output_folder, "data", "brenda.arrow")
 
-    if not (not os.path.exists(brenda_pickle) or overwrite):
+    if not (not os.path.exists(brenda_arrow) or overwrite):
         logger.info("dl_brenda nothing to be done")
         return
     
     logger = customLog.set_context(logger, "brenda")
-    logger.info("Start of the extraction")
-    parse.extract_tar(brenda_data_compressed, os.path.join(output_folder, "data"))
     logger.info("Start of the parsing")
-    parse.brenda(brenda_data_uncompressed, brenda_pickle, logger=logger)
-
-    for file in brenda_file_delete:
-        if os.path.isfile(file):
-            os.remove(file)
+    # the flat file is read straight from the archive
+    cache.cached(
+        "brenda", parse.PARSER_VERSIONS["brenda"], [cache.file_digest(brenda_data_compressed)], [brenda_arrow],
+        lambda: parse.brenda(brenda_data_compressed, brenda_arrow, logger=logger,
+                             memory_budget=config["brenda"].get("memory_budget")),
+        logger,
+        force=force,
+    )
     logger.info("Done")
 
 
-def dl_pdb(output_folder,overwrite=False):
+def dl_pdb(output_folder,overwrite=False,force=False):
     """download pdb data"""  
     global config
     global logger
 
     pdb_url = config["pdb"]["url"]
     pdb_subfolder_path = os.path.join(output_folder, "pdb")
-    pdb_pickle = os.path.join(output_folder, "data", "pdb.pickle")
+    pdb_arrow = os.path.join(output_folder, "data", "pdb.arrow")
+    pdb_fingerprint = os.path.join(output_folder, "data", "pdb_release.json")
+    pdb_manifest = os.path.join(output_folder, "data", "pdb_manifest.pickle")
     pdb_worker = config["pdb"]["worker"]
 
-    if not (not os.path.exists(pdb_pickle)):
+    if not (not os.path.exists(pdb_arrow) or overwrite):
         logger.info("dl_pdb nothing to be done")
         return
     
     logger = customLog.set_context(logger, "pdb")
-    logger.info("Start of the download")
+    logger.info("Start of the listing")
     pdb_subfolders = download.pdb_get_subfolder(pdb_url)
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=pdb_worker)
-    futures = [
-        executor.submit(download.pdb_download_subfolder, pdb_url, pdb_subfolder_path, folder) for folder in pdb_subfolders
-    ]
-    concurrent.futures.wait(futures)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pdb_worker) as executor:
+        listings = dict(zip(pdb_subfolders, executor.map(lambda folder: download.pdb_list_subfolder(pdb_url, folder), pdb_subfolders)))
+    for folder in pdb_subfolders:
+        if listings[folder] is None:
+            logger.error(f"Could not list the subfolder {folder}")
+    release = download.pdb_fingerprint(listings)
+    if os.path.exists(pdb_arrow) and not force and utils.is_unchanged(release, pdb_fingerprint, logger):
+        logger.info("dl_pdb upstream release unchanged, nothing to be done")
+        return
+
+    # manifest of the files already parsed: {"folder/file name": {"mtime", "size", "version", "pdb_ids"}},
+    # the rows of the unchanged files are taken from the previous table, without it every file is parsed again
+    manifest = {}
+    if not force and os.path.exists(pdb_manifest) and os.path.exists(pdb_arrow):
+        manifest = utils.load_pickle(pdb_manifest, logger) or {}
+    changed, withdrawn = download.pdb_changes(manifest, listings, parse.PDB_PARSER_VERSION)
+    logger.info(f"{len(changed)} new or changed files, {len(withdrawn)} withdrawn files")
+
+    logger.info("Start of the download")
+    jobs = download.pdb_jobs(pdb_url, pdb_subfolder_path, changed)
+    failed = download.download_files(jobs, logger, worker=pdb_worker, queue_size=config["pdb"].get("queue_size"),
+                                     quarantine_folder=os.path.join(config["output"], "quarantine", "pdb"))
+    failed_files = {os.path.relpath(local_path, pdb_subfolder_path) for url, local_path in failed}
 
     logger.info("Start of the parsing")
-    parse.multiprocessing_pdb_iterate(pdb_subfolder_path, pdb_pickle, logger=logger)
+    # the new table is written aside, the previous one is read while it is built
+    pdb_new_arrow = os.path.join(output_folder, "data", "pdb.new.arrow")
+    buffer = columnar.SpillBuffer("pdb", pdb_new_arrow, logger, config["pdb"].get("memory_budget"))
+    downloaded = [path for path in changed if path not in failed_files]
+    pdb_ids, parse_failed = parse.multiprocessing_pdb_files(
+        [os.path.join(pdb_subfolder_path, path) for path in downloaded], buffer, logger,
+        worker=config["pdb"].get("parse_worker"), batch_bytes=config["pdb"].get("batch_bytes", parse.PDB_BATCH_BYTES),
+    )
+    parsed = [path for path in downloaded if os.path.join(pdb_subfolder_path, path) not in parse_failed]
+
+    # the rows of the files parsed again or withdrawn are dropped from the previous table, a pdb id has a single file
+    if manifest:
+        stale = {pdb_id for path in withdrawn + parsed if path in manifest for pdb_id in manifest[path]["pdb_ids"]}
+        buffer.extend(row for row in columnar.read_rows(pdb_arrow, logger) if row[1] not in stale)
+    buffer.close()
+    os.replace(pdb_new_arrow, pdb_arrow)
+    for path in withdrawn:
+        manifest.pop(path)
+        if os.path.isfile(os.path.join(pdb_subfolder_path, path)):
+            os.remove(os.path.join(pdb_subfolder_path, path))
+    for path in parsed:
+        folder, name = path.split("/")
+        mtime, size = listings[folder + "/"][name]
+        manifest[path] = {
+            "mtime": mtime, "size": size, "version": parse.PDB_PARSER_VERSION,
+            "pdb_ids": pdb_ids.get(os.path.join(pdb_subfolder_path, path), []),
+        }
+
+    utils.save_pickle(manifest, pdb_manifest, logger)
+    if len(parsed) == len(changed):
+        utils.save_fingerprint(release, pdb_fingerprint, logger)
+    else:
+        # the release is not recorded so that the next run fetches the missing files again
+        logger.error(f"{len(changed) - len(parsed)} files could not be downloaded or parsed")
     logger.info("Done")
 
 
-def populate_db(output_folder,database):
-    """Populate the DB with data in pickle"""
+def populate_db(output_folder,database,report_file=None):
+    """Populate the DB with the parsed data (Arrow files, or shards of the pipeline mode), the rows loaded and skipped per source are written to report_file"""
     global config
     global logger
     
     logger = customLog.set_context(logger, "Populating")
     logger.info("Start of db populating")
+    con = utils.create_connection(database, logger)
+    if not con:
+        sys.exit()
+    settings = config.get("populate") or {}
+    cache_size = settings.get("cache_size", 1 << 30)
+    if settings.get("bulk", True):
+        utils.set_bulk_load(con, cache_size, logger)
+    worker = settings.get("worker", 1)
+    # only apply the differences between the parsed data and the tables of the input database
+    delta = settings.get("delta", False)
+    # loaded after explorenz, in this order (the first source giving an ec number sets its completeness),
+    # a source parsed in pipeline mode comes as a shard already filled (see uniprot_pipeline)
+    sources = []
+    for source in populate.SOURCE_TABLES:
+        arrow = os.path.join(output_folder, "data", f"{source}.arrow")
+        shard_file = os.path.join(output_folder, "data", f"{source}.shard")
+        if (config.get(source) or {}).get("pipeline", False):
+            if os.path.exists(shard_file): sources.append((source, None, shard_file))
+        elif os.path.exists(arrow):
+            sources.append((source, arrow, f"{database}.{source}.shard"))
+    report = {}
     try:
-        explorenz_ec_pickle = os.path.join(output_folder, "data", "explorenz_ec.pickle")
-        if os.path.exists(explorenz_ec_pickle): populate.explorenz_ec(explorenz_ec_pickle, database, logger)
-        explorenz_nomenclature_pickle = os.path.join(output_folder, "data", "explorenz_nomenclature.pickle")
-        if os.path.exists(explorenz_nomenclature_pickle): populate.explorenz_nomenclature(explorenz_nomenclature_pickle, database, logger=logger)
-        sprot_pickle = os.path.join(output_folder, "data", "sprot.pickle")
-        if os.path.exists(sprot_pickle): populate.uniprot(filename=sprot_pickle, database=database, table_type="sprot", logger=logger)
-        trembl_pickle = os.path.join(output_folder, "data", "trembl.pickle")    
-        if os.path.exists(trembl_pickle): populate.uniprot(filename=trembl_pickle, database=database, table_type="trembl", logger=logger)
-        kegg_pickle = os.path.join(output_folder, "data", "kegg.pickle")
-        if os.path.exists(kegg_pickle): populate.kegg(filename=kegg_pickle, database=database, logger=logger)
-        brenda_pickle = os.path.join(output_folder, "data", "brenda.pickle")    
-        if os.path.exists(brenda_pickle): populate.brenda(filename=brenda_pickle, database=database, logger=logger)
-        pdb_pickle = os.path.join(output_folder, "data", "pdb.pickle")
-        if os.path.exists(pdb_pickle): populate.pdb(filename=pdb_pickle, database=database, logger=logger)
+        explorenz_ec_arrow = os.path.join(output_folder, "data", "explorenz_ec.arrow")
+        if os.path.exists(explorenz_ec_arrow): report["explorenz_ec"] = populate.explorenz_ec(explorenz_ec_arrow, con, logger, delta)
+        explorenz_nomenclature_arrow = os.path.join(output_folder, "data", "explorenz_nomenclature.arrow")
+        if os.path.exists(explorenz_nomenclature_arrow): report["explorenz_nomenclature"] = populate.explorenz_nomenclature(explorenz_nomenclature_arrow, con, logger, delta)
+        parallel = worker > 1 and len([arrow for _, arrow, _ in sources if arrow]) > 1
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=worker) if parallel else None
+        # the shards start from a snapshot taken before the merges, they never open the database being written
+        template_file = f"{database}.template.shard"
+        try:
+            futures = {}
+            if parallel:
+                populate.shard_template(database, template_file, logger)
+                # each source is loaded in a shard of its own by a separate process, the shards are merged one by one
+                for source, arrow, shard_file in sources:
+                    if arrow:
+                        shard_logger = customLog.set_context(logger, source)
+                        futures[source] = executor.submit(populate.build_shard, source, arrow, template_file, shard_file, cache_size, shard_logger)
+            for source, arrow, shard_file in sources:
+                if arrow and not parallel:
+                    report[source] = populate.populate_source(source, arrow, con, logger, delta)
+                    continue
+                try:
+                    report[source] = futures[source].result() if arrow else {}
+                    report[source].update(populate.merge_shard(con, source, shard_file, logger, delta))
+                except Exception as e:
+                    logger.exception(f"The {source} data could not be loaded, its tables are unchanged: {e}")
+                finally:
+                    if arrow and os.path.exists(shard_file):
+                        os.remove(shard_file)
+        finally:
+            if executor:
+                executor.shutdown()
+            if os.path.exists(template_file):
+                os.remove(template_file)
     except ValueError as e:
         logger.exception(e)
+    finally:
+        con.close()
+    if report_file:
+        utils.save_report(report, report_file, logger)
 
 
 def link_tables(database):
@@ -216,10 +468,8 @@ def link_tables(database):
 
     logger = customLog.set_context(logger, "linking")
     logger.info("Start of linking")
-    link.pdb(database, logger)
-    link.swiss_explorenz(database, "sprot", logger)
-    link.swiss_explorenz(database, "trembl", logger)
-    link.species(database, logger)
+    link.enzyme_counts(database, logger)
+    link.rollup(database, logger)
     logger.info("End of linking")
  
 
@@ -232,9 +482,14 @@ def main():
                                              'dl_kegg', 'dl_brenda', 'dl_pdb', 'populate', 'all'], 
                         help="The function to execute.")
     parser.add_argument("--overwrite", action="store_true", 
-                        help="Use this option to force overwrite of already existing pickle files.") 
+                        help="Use this option to force overwrite of already existing parsed files.") 
+    parser.add_argument("--force", action="store_true",
+                        help="With --overwrite, download and parse again even if the upstream release did not change.")
     args = parser.parse_args()
 
+    scheduler.configure(config.get("scheduler"))
+    cache.configure(config.get("cache"), os.path.join(config["output"], "cache"))
+
     input_database = config.get("input_database",None)
     if not os.path.exists(input_database):
        input_database = None
@@ -251,34 +506,47 @@ def main():
         os.system(f"cp {output_folder}/data/* {tmpdir}/data/")
 
     if (args.function == "dl_explorenz" or args.function == "all") and config["download"]["explorenz"]:
-        dl_explorenz(tmpdir,overwrite=args.overwrite)
-        os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
-        os.system(f"rm -r {tmpdir}")
+        try:
+            dl_explorenz(tmpdir,overwrite=args.overwrite,force=args.force)
+        finally:
+            # also keeps an interrupted download so that the next run resumes it
+            os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
+            os.system(f"rm -r {tmpdir}")
     
     if (args.function == "dl_sprot" or args.function == "all") and config["download"]["sprot"]:
-        dl_sprot(tmpdir,overwrite=args.overwrite)
-        os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
-        os.system(f"rm -r {tmpdir}")
+        try:
+            dl_sprot(tmpdir,overwrite=args.overwrite,force=args.force)
+        finally:
+            os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
+            os.system(f"rm -r {tmpdir}")
 
     if (args.function == "dl_trembl" or args.function == "all") and config["download"]["trembl"]:
-        dl_trembl(tmpdir,overwrite=args.overwrite)
-        os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
-        os.system(f"rm -r {tmpdir}")
+        try:
+            dl_trembl(tmpdir,overwrite=args.overwrite,force=args.force)
+        finally:
+            os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
+            os.system(f"rm -r {tmpdir}")
 
     if (args.function == "dl_kegg" or args.function == "all") and config["download"]["kegg"]:
-        dl_kegg(tmpdir,overwrite=args.overwrite)
-        os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
-        os.system(f"rm -r {tmpdir}")
+        try:
+            dl_kegg(tmpdir,overwrite=args.overwrite,force=args.force)
+        finally:
+            os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
+            os.system(f"rm -r {tmpdir}")
 
     if (args.function == "dl_brenda" or args.function == "all") and config["download"]["brenda"]:
-        dl_brenda(tmpdir,overwrite=args.overwrite)
-        os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
-        os.system(f"rm -r {tmpdir}")
+        try:
+            dl_brenda(tmpdir,overwrite=args.overwrite,force=args.force)
+        finally:
+            os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
+            os.system(f"rm -r {tmpdir}")
 
     if (args.function == "dl_pdb" or args.function == "all") and config["download"]["pdb"]:
-        dl_pdb(tmpdir,overwrite=args.overwrite)
-        os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
-        os.system(f"rm -r {tmpdir}")
+        try:
+            dl_pdb(tmpdir,overwrite=args.overwrite,force=args.force)
+        finally:
+            os.system(f"mv {tmpdir}/data/* {output_folder}/data/")
+            os.system(f"rm -r {tmpdir}")
 
     if args.function == "populate" or args.function == "all":
         if not os.path.exists(os.path.dirname(database)):
@@ -290,12 +558,15 @@ def main():
             os.system(f"cp {input_database} {database}")
         os.system(f"cp {output_folder}/data/* {tmpdir}/data/")
         os.system(f"cp {database} {tmpdir}/")
-        populate_db(tmpdir,os.path.join(tmpdir,os.path.basename(database)))
+        populate_db(tmpdir,os.path.join(tmpdir,os.path.basename(database)),
+                    report_file=os.path.join(os.path.dirname(database),"populate_report.json"))
         link_tables(os.path.join(tmpdir,os.path.basename(database)))
         os.system(f"mv {tmpdir}/{os.path.basename(database)} {database}")
         os.system(f"rm -r {tmpdir}")
         os.system(f'echo "End update: $(date +%F)" >> {output_folder}/last_update.txt')
 
+    scheduler.get_scheduler().log_metrics(logger)
+
 if __name__ == "__main__":
     main()    
 
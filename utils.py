@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import hashlib
+import json
+import os
 import pickle
 import sqlite3
 from datetime import datetime
@@ -31,6 +34,25 @@ def create_connection(database: str, logger):
     return con
 
 
+def set_bulk_load(con, cache_size: int, logger):
+    """
+    Tune a connection for the build of the database: no rollback journal and no
+    sync to the disk, so a crash leaves a corrupted file. Temporary data (index builds,
+    staged rows) stays on disk, it can be larger than the memory. Only to be used on the
+    scratch copy of the database in tmpdir.
+    Args:
+        con: connection to the database
+        cache_size: size in bytes of the page cache of the connection
+    """
+    try:
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        # a negative cache_size is a number of KiB instead of pages
+        con.execute(f"PRAGMA cache_size = {-(int(cache_size) >> 10)}")
+    except sqlite3.Error as e:
+        logger.exception(f"Error setting the bulk load pragmas: {e}")
+
+
 def save_pickle(data: dict, output_file: str, logger):
     """
     This function stores a dictionary of parsed data as a pickle file.
@@ -61,3 +83,96 @@ def load_pickle(input_file: str, logger):
     except Exception as e:
         logger.exception("Error occurred while loading pickle file: ", e)
         return None
+
+
+def load_fingerprint(fingerprint_file: str, logger):
+    """
+    This function loads the release fingerprint recorded at the last update of a source.
+    Args:
+        fingerprint_file: Name and path of the fingerprint file.
+    Returns:
+        The recorded fingerprint, None if there is none.
+    """
+    if not os.path.exists(fingerprint_file):
+        return None
+    try:
+        with open(fingerprint_file, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.exception(f"Error occurred while loading fingerprint file: {e}")
+        return None
+
+
+def save_fingerprint(fingerprint: dict, fingerprint_file: str, logger):
+    """
+    This function records the release fingerprint of a source once it has been parsed.
+    Args:
+        fingerprint: a dictionary identifying the upstream release
+        fingerprint_file: name and path of the fingerprint file
+    """
+    if not fingerprint:
+        return
+    try:
+        with open(fingerprint_file, "w") as f:
+            json.dump(fingerprint, f, indent=2, sort_keys=True)
+    except Exception as e:
+        logger.exception(f"Error occurred while saving fingerprint file: {e}")
+
+
+def save_report(report: dict, report_file: str, logger):
+    """
+    This function writes the report of a step of the update (rows loaded, invalid ec numbers...).
+    Args:
+        report: a dictionary of json serializable values
+        report_file: name and path of the report file
+    """
+    try:
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        logger.exception(f"Error occurred while saving report file: {e}")
+
+
+def response_fingerprint(response):
+    """
+    Extract the validators sent by the server that identify the version of a resource.
+    Args:
+        response: Response object of a HEAD or GET request.
+    Returns:
+        Dictionary of the ETag, Last-Modified and Content-Length headers that are present.
+    """
+    return {
+        header: response.headers[header]
+        for header in ("ETag", "Last-Modified", "Content-Length")
+        if header in response.headers
+    }
+
+
+def page_fingerprint(response):
+    """
+    Fingerprint of a page fetched with GET: its validators, or the sha256 of its content if the server sends none.
+    Args:
+        response: Response object of a GET request, with its body loaded.
+    Returns:
+        Dictionary identifying the version of the page.
+    """
+    fingerprint = response_fingerprint(response)
+    # the length of a page changes with its compression
+    fingerprint.pop("Content-Length", None)
+    if not fingerprint:
+        fingerprint["sha256"] = hashlib.sha256(response.content).hexdigest()
+    return fingerprint
+
+
+def is_unchanged(fingerprint: dict, fingerprint_file: str, logger):
+    """
+    Compare the fingerprint of the upstream release with the recorded one.
+    Args:
+        fingerprint: fingerprint of the current upstream release (None if unknown)
+        fingerprint_file: name and path of the recorded fingerprint
+    Returns:
+        True if both are known and identical, False otherwise.
+    """
+    if not fingerprint:
+        return False
+    return load_fingerprint(fingerprint_file, logger) == fingerprint